@@ -0,0 +1,161 @@
+"""
+Benchmarks for loading and processing PetAdmin data.
+
+Run against a configured environment with, for example,
+    python -m pytadmin.benchmark load
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from .env import Environment
+from .petadmin import PetAdmin
+from .booking import Booking
+from .pet import Pet
+from .run import Runs
+
+
+def bench_load(env, repeat=3, workers=4):
+    """
+    Wall-clock time of a full PetAdmin.load, serial against concurrent.
+    :return: {mode: best time in seconds}
+    """
+    results = {}
+    for mode, concurrent in (('serial', False), ('concurrent', True)):
+        times = []
+        for _ in range(repeat):
+            petadmin = PetAdmin(env)
+            start = time.perf_counter()
+            petadmin.load(concurrent=concurrent, workers=workers)
+            times.append(time.perf_counter() - start)
+        results[mode] = min(times)
+        print(f'load {mode:<12}{results[mode]:8.2f}s')
+
+    print(f'speedup       {results["serial"] / results["concurrent"]:8.2f}x')
+    return results
+
+
+def bench_memory(env):
+    """
+    Memory held by a fully loaded PetAdmin, in bytes per loaded booking.
+    Run it on an older checkout to compare representations.
+    """
+    gc.collect()
+    tracemalloc.start()
+    petadmin = PetAdmin(env)
+    petadmin.load()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    bookings = len(petadmin.bookings.bookings)
+    per_booking = size / bookings if bookings else 0
+    print(
+        f'memory        {size / 2 ** 20:8.1f}MB for {bookings} bookings, '
+        f'{per_booking:.0f} bytes per booking')
+    return per_booking
+
+
+def bench_allocation(env=None, dog_runs=60, cat_pens=30, bookings=450,
+                     days=70, seed=1):
+    """
+    Batch allocation of a synthetic peak season: bookings of one to three
+    dogs or cats, staying 2-21 nights, spread over the given number of days.
+    Needs no database.
+    :return: (seconds, number allocated, number unplaced)
+    """
+    rng = random.Random(seed)
+    runs = Runs(env, None, None)
+    rows = [(n, f'D{n}', 'Dog', 'Standard') for n in range(dog_runs)]
+    rows += [
+        (dog_runs + n, f'C{n}', 'Cat', 'Standard') for n in range(cat_pens)]
+    runs.load_run_rows(rows)
+
+    season = datetime(2026, 7, 1)
+    batch = []
+    for bk_no in range(bookings):
+        booking = Booking(bk_no)
+        booking.start_date = season + timedelta(days=rng.randrange(days))
+        booking.end_date = booking.start_date + timedelta(
+            days=rng.randint(2, 21))
+        spec = rng.choice(('Dog', 'Dog', 'Cat'))
+        for n in range(rng.randint(1, 3)):
+            pet = Pet(bk_no * 3 + n)
+            pet.spec = spec
+            booking.pets.append(pet)
+        batch.append(booking)
+    runs.compute_vacancies()
+
+    start = time.perf_counter()
+    allocated, unplaced = runs.allocate_bookings(batch)
+    elapsed = time.perf_counter() - start
+    print(
+        f'allocation    {elapsed:8.3f}s for {len(batch)} bookings, '
+        f'{len(allocated)} allocated, {len(unplaced)} unplaced')
+    return elapsed, len(allocated), len(unplaced)
+
+
+def bench_render(env, count=50):
+    """
+    Time to render the html and text bodies of a confirmation, over up to
+    count upcoming bookings: cold, compiling both templates for every
+    booking as before the cache, then warm.
+    :return: {pass: seconds per confirmation}
+    """
+    # confirmations need mako and the settings module, unlike the rest
+    from .confirmation import (
+        ConfirmationCandidate, ReportParameters, _templates)
+
+    petadmin = PetAdmin(env)
+    petadmin.load()
+    now = datetime.now()
+    bk_nos = [
+        booking.no for booking in petadmin.bookings.bookings.values()
+        if booking.start_date and booking.start_date > now][:count]
+    report_parameters = ReportParameters(env)
+    # no compiled modules on disk either
+    cold_parameters = ReportParameters(env)
+    cold_parameters.module_directory = None
+
+    results = {}
+    for name, parameters in (
+            ('cold', cold_parameters), ('warm', report_parameters)):
+        elapsed = 0.0
+        for bk_no in bk_nos:
+            if name == 'cold':
+                _templates.clear()
+            cc = ConfirmationCandidate(petadmin, bk_no)
+            cc.prepare(parameters)
+            start = time.perf_counter()
+            cc.confirmation_body(parameters)
+            cc.confirmation_body(parameters, body_format='txt')
+            elapsed += time.perf_counter() - start
+        results[name] = elapsed / len(bk_nos) if bk_nos else 0
+        print(
+            f'render {name:<7}{results[name] * 1000:8.1f}ms per confirmation '
+            f'({len(bk_nos)} bookings)')
+    return results
+
+
+BENCHMARKS = {
+    'load': bench_load,
+    'memory': bench_memory,
+    'allocation': bench_allocation,
+    'render': bench_render,
+}
+
+
+def main(args):
+    names = args or list(BENCHMARKS)
+    env = Environment('benchmark')
+    try:
+        for name in names:
+            BENCHMARKS[name](env)
+    finally:
+        env.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
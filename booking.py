@@ -1,5 +1,102 @@
+from bisect import bisect_right
+from datetime import datetime
 from decimal import Decimal
 
+SQL_BOOKING = """
+Select bk_no, bk_cust_no, bk_create_date, bk_start_datetime, bk_end_datetime,
+bk_gross_amt, bk_paid_amt, bk_status, bk_peak, bk_deluxe, bk_skip_confirm,
+bk_pickup_no from vwbooking"""
+SQL_BOOKINGITEM = """
+Select bi_bk_no, bi_pet_no from vwbookingitem_simple"""
+SQL_INVITEM = """
+Select ii_bk_no, ii_pet_no, ii_srv_no, ii_quantity, ii_rate from vwinvitem"""
+SQL_INVEXTRA = """
+Select ie_bk_no, ie_desc, ie_unit_price, ie_quantity from vwinvextra"""
+SQL_PAYMENT = """
+Select pay_bk_no, pay_date, pay_amount, pay_type from vwpayment_simple"""
+
+
+def _filtered(sql, conditions):
+    if not conditions:
+        return sql
+    return sql + '\nwhere ' + ' and '.join(conditions)
+
+
+def _set_booking_fields(booking, row):
+    booking.create_date = row[2]
+    booking.start_date = row[3]
+    booking.end_date = row[4]
+    booking.gross_amt = row[5]
+    booking.paid_amt = row[6]
+    booking.status = intern_str(row[7])
+    booking.peak = row[8]
+    booking.deluxe = row[9]
+    booking.skip = row[10]
+    booking.pickup = row[11]
+
+
+# index buckets are dicts by bk_no, so that removal is O(1) even for the
+# large buckets of by_status
+def _add_to_index(index, key, booking):
+    if key in index:
+        index[key][booking.no] = booking
+    else:
+        index[key] = {booking.no: booking}
+
+
+def _remove_from_index(index, key, booking):
+    bucket = index.get(key)
+    if bucket is not None and bucket.get(booking.no) is booking:
+        del bucket[booking.no]
+        if not bucket:
+            del index[key]
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+class IntervalIndex:
+    """
+    Bookings sorted by start date, with a max-end segment tree on top, so
+    overlap queries cost O((k + 1) log n) for k results
+    """
+
+    def __init__(self, bookings):
+        stays = sorted(
+            (b.start_date.date().toordinal(), b.end_date.date().toordinal(),
+             b.no, b) for b in bookings)
+        self.starts = [stay[0] for stay in stays]
+        self.ends = [stay[1] for stay in stays]
+        self.bookings = [stay[3] for stay in stays]
+        self.size = 1
+        while self.size < len(stays):
+            self.size *= 2
+        self.max_end = [-1] * (2 * self.size)
+        self.max_end[self.size:self.size + len(stays)] = self.ends
+        for i in range(self.size - 1, 0, -1):
+            self.max_end[i] = max(self.max_end[2 * i], self.max_end[2 * i + 1])
+
+    def overlapping(self, from_ordinal, to_ordinal):
+        # candidates start no later than to_ordinal: a prefix of the array
+        limit = bisect_right(self.starts, to_ordinal)
+        found = []
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo >= limit or self.max_end[node] < from_ordinal:
+                continue
+            if hi - lo == 1:
+                found.append(self.bookings[lo])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return found
+
+
 class Bookings:
     """Representing a collection of Booking objects
     """
@@ -8,93 +105,241 @@ class Bookings:
         self.bookings = {}
         self.by_start_date = {}
         self.env = env
+        self.by_customer = {}
+        self.by_end_date = {}
+        self.by_status = {}
+        # interval index over stays, rebuilt on demand after changes
+        self.intervals = None
         self.loaded = False
         self.customers = customers
         self.pets = pets
         self.services = services
+        # when lazy, get() fetches a missing booking on demand
+        self.lazy = False
+        self.missing = set()
+        # columnar view for analytics, built on demand by get_columns()
+        self.columns = None
 
     def get(self, bk_no):
         if bk_no in self.bookings:
             return self.bookings[bk_no]
-        else:
-            return None
+
+        if self.lazy and not self.loaded and bk_no not in self.missing:
+            log.debug(f'Fetching booking #{bk_no} on demand')
+            self.missing |= self.reload([bk_no])
+            return self.bookings.get(bk_no)
+
+        return None
+
+    def get_columns(self):
+        """
+        A BookingColumns view of the loaded bookings, for vectorized filters
+        and aggregates. Requires numpy.
+        The view is rebuilt after bookings or payments are (re)loaded or
+        dropped. Changes made to Booking objects in memory are not seen.
+        """
+        if self.columns is None:
+            from .columns import BookingColumns
+            self.columns = BookingColumns(self.bookings.values())
+        return self.columns
 
     def get_by_start_date(self, start_date):
         self.load()
         if start_date in self.by_start_date:
-            return self.by_start_date[start_date]
+            return list(self.by_start_date[start_date].values())
         
         return []
         
-    def load_by_sql(self, sql_booking, sql_bookingitem, sql_invitem,
-            sql_invextra, sql_payment):
-        cursor = self.env.get_cursor()
-        cursor.execute(sql_booking)
+    def iter_bookings(self, cust_no=None, from_date=None, to_date=None,
+                      status=None, batch_size=None):
+        """
+        Stream bookings straight from the database, without adding them to
+        the collection. Customers are taken from the collection if loaded;
+        pets, items and payments are not populated.
+        :param cust_no:   only bookings of this customer
+        :param from_date: only bookings starting on or after this date
+        :param to_date:   only bookings starting on or before this date
+        :param status:    only bookings with this status
+        """
+        conditions = []
+        params = []
+        if cust_no is not None:
+            conditions.append("bk_cust_no = %s")
+            params.append(int(cust_no))
+        if from_date is not None:
+            conditions.append("bk_start_datetime >= %s")
+            params.append(from_date)
+        if to_date is not None:
+            conditions.append("bk_start_datetime < dateadd(day, 1, %s)")
+            params.append(to_date)
+        if status is not None:
+            conditions.append("bk_status = %s")
+            params.append(status)
+
+        sql = _filtered(SQL_BOOKING, conditions)
+        for row in self.env.iter_query(sql, params, batch_size):
+            booking = Booking(row[0])
+            booking.customer = self.customers.customers.get(row[1])
+            _set_booking_fields(booking, row)
+            yield booking
+
+    def iter_payments(self, bk_no=None, cust_no=None, from_date=None,
+                      to_date=None, batch_size=None):
+        """
+        Stream payments straight from the database as (bk_no, Payment) pairs,
+        without attaching them to bookings
+        """
+        conditions = []
+        params = []
+        if bk_no is not None:
+            conditions.append("pay_bk_no = %s")
+            params.append(int(bk_no))
+        if cust_no is not None:
+            conditions.append("pay_cust_no = %s")
+            params.append(int(cust_no))
+        if from_date is not None:
+            conditions.append("pay_date >= %s")
+            params.append(from_date)
+        if to_date is not None:
+            conditions.append("pay_date < dateadd(day, 1, %s)")
+            params.append(to_date)
+
+        sql = _filtered(SQL_PAYMENT, conditions)
+        for row in self.env.iter_query(sql, params, batch_size):
+            yield row[0], Payment(row[1], row[2], intern_str(row[3]))
+
+    def iter_inv_items(self, bk_no=None, cust_no=None, batch_size=None):
+        """
+        Stream inventory items straight from the database as
+        (bk_no, InventoryItem) pairs, without attaching them to bookings.
+        Pets and services are taken from their collections if loaded.
+        """
+        conditions = []
+        params = []
+        if bk_no is not None:
+            conditions.append("ii_bk_no = %s")
+            params.append(int(bk_no))
+        if cust_no is not None:
+            conditions.append("ii_cust_no = %s")
+            params.append(int(cust_no))
+
+        sql = _filtered(SQL_INVITEM, conditions)
+        for row in self.env.iter_query(sql, params, batch_size):
+            pet = self.pets.pets.get(row[1])
+            service = self.services.services.get(row[2])
+            yield row[0], InventoryItem(pet, service, row[3], row[4])
 
-        for row in cursor:
+    def load_by_sql(self, sql_booking, sql_bookingitem, sql_invitem,
+            sql_invextra, sql_payment, params=None):
+        # each query is streamed on a connection of its own, so that lazy
+        # lookups made while the rows are processed do not cut it short
+        iter_query = self.env.iter_query
+        self.load_booking_rows(iter_query(sql_booking, params))
+        self.load_bookingitem_rows(iter_query(sql_bookingitem, params))
+        self.load_invitem_rows(iter_query(sql_invitem, params))
+        self.load_invextra_rows(iter_query(sql_invextra, params))
+        self.load_payment_rows(iter_query(sql_payment, params))
+
+    def load_booking_rows(self, rows):
+        self.columns = None
+        for row in rows:
             bk_no = row[0]
-            booking = Booking(bk_no)
+            booking = self.bookings.get(bk_no)
+            if booking is None:
+                booking = Booking(bk_no)
+                self.bookings[bk_no] = booking
+            else:
+                # reloading - lines are re-read by the subsequent queries
+                self.unindex(booking)
+                booking.pets = []
+                booking.inv_items = []
+                booking.extra_items = []
+                booking.payments = []
             cust_no = row[1]
-            booking.customer = self.customers.get(cust_no)
-            booking.create_date = row[2]
-            booking.start_date = row[3]
-            booking.end_date = row[4]
-            booking.gross_amt = row[5]
-            booking.paid_amt = row[6]
-            booking.status = row[7]
-            booking.peak = row[8]
-            booking.deluxe = row[9]
-            booking.skip = row[10]
-            booking.pickup = row[11]
-            self.bookings[bk_no] = booking
-            sdate = booking.start_date.date()
-            if booking.status == '' or booking.status == 'V':
-                if sdate in self.by_start_date:
-                    self.by_start_date[sdate].append(booking)
-                else:
-                    self.by_start_date[sdate] = [booking]
-
-        cursor.execute(sql_bookingitem)
-
-        for row in cursor:
-            booking = self.get(row[0])
-            pet = self.pets.get(row[1])
+            booking.customer = self.customers.customers.get(cust_no)
+            _set_booking_fields(booking, row)
+            self.index(booking)
+
+    def index(self, booking):
+        sdate = booking.start_date.date()
+        if booking.status == '' or booking.status == 'V':
+            _add_to_index(self.by_start_date, sdate, booking)
+        if booking.customer:
+            _add_to_index(self.by_customer, booking.customer.no, booking)
+        _add_to_index(self.by_end_date, booking.end_date.date(), booking)
+        _add_to_index(self.by_status, booking.status, booking)
+        self.intervals = None
+
+    def unindex(self, booking):
+        sdate = booking.start_date.date()
+        _remove_from_index(self.by_start_date, sdate, booking)
+        if booking.customer:
+            _remove_from_index(self.by_customer, booking.customer.no, booking)
+        _remove_from_index(self.by_end_date, booking.end_date.date(), booking)
+        _remove_from_index(self.by_status, booking.status, booking)
+        self.intervals = None
+        self.columns = None
+
+    def for_customer(self, cust_no):
+        """Loaded bookings of a customer"""
+        return list(self.by_customer.get(cust_no, {}).values())
+
+    def departing_on(self, end_date):
+        """Loaded bookings ending on a given date"""
+        return list(self.by_end_date.get(_as_date(end_date), {}).values())
+
+    def with_status(self, status):
+        """Loaded bookings with a given status"""
+        return list(self.by_status.get(status, {}).values())
+
+    def overlapping(self, from_date, to_date):
+        """
+        Loaded bookings staying at any time between from_date and to_date
+        (inclusive), in start date order
+        """
+        if self.intervals is None:
+            self.intervals = IntervalIndex(self.bookings.values())
+        return self.intervals.overlapping(
+            _as_date(from_date).toordinal(), _as_date(to_date).toordinal())
+
+    def load_bookingitem_rows(self, rows):
+        for row in rows:
+            booking = self.bookings.get(row[0])
+            pet = self.pets.pets.get(row[1])
             if not booking:
                 pass
             else:
                 booking.pets.append(pet)
 
-        cursor.execute(sql_invitem)
-
-        for row in cursor:
-            booking = self.get(row[0])
+    def load_invitem_rows(self, rows):
+        for row in rows:
+            booking = self.bookings.get(row[0])
             if booking:
-                pet = self.pets.get(row[1])
-                service = self.services.get(row[2])
+                pet = self.pets.pets.get(row[1])
+                service = self.services.services.get(row[2])
                 inv_item = InventoryItem(pet, service, row[3], row[4])
                 booking.inv_items.append(inv_item)
 
-        cursor.execute(sql_invextra)
-
-        for row in cursor:
-            booking = self.get(row[0])
+    def load_invextra_rows(self, rows):
+        for row in rows:
+            booking = self.bookings.get(row[0])
             if booking:
-                desc = row[1]
+                desc = intern_str(row[1])
                 unit_price = row[2]
                 quantity = row[3]
                 extra_item = ExtraItem(desc, unit_price, quantity)
                 booking.extra_items.append(extra_item)
 
-        cursor.execute(sql_payment)
-
-        for row in cursor:
-            booking = self.get(row[0])
-            pay_date = row[1]
-            amount = row[2]
-            pay_type = row[3]
-            payment = Payment(pay_date, amount, pay_type)
-            booking.payments.append(payment)
-
+    def load_payment_rows(self, rows):
+        self.columns = None
+        for row in rows:
+            booking = self.bookings.get(row[0])
+            if booking:
+                pay_date = row[1]
+                amount = row[2]
+                pay_type = intern_str(row[3])
+                payment = Payment(pay_date, amount, pay_type)
+                booking.payments.append(payment)
 
     def load(self, force=False):
         if self.loaded and not force:
@@ -102,21 +347,13 @@ class Bookings:
 
         log.debug('Loading Bookings')
 
-        sql_booking = """
-Select bk_no, bk_cust_no, bk_create_date, bk_start_datetime, bk_end_datetime,
-bk_gross_amt, bk_paid_amt, bk_status, bk_peak, bk_deluxe, bk_skip_confirm,
-bk_pickup_no from vwbooking"""
-        sql_bookingitem = """
-Select bi_bk_no, bi_pet_no from vwbookingitem_simple"""
-        sql_invitem = """
-Select ii_bk_no, ii_pet_no, ii_srv_no, ii_quantity, ii_rate from vwinvitem"""
-        sql_invextra = """
-Select ie_bk_no, ie_desc, ie_unit_price, ie_quantity from vwinvextra"""
-        sql_payment = """
-Select pay_bk_no, pay_date, pay_amount, pay_type from vwpayment_simple"""
-
-        self.load_by_sql(sql_booking, sql_bookingitem, sql_invitem, sql_invextra,
-            sql_payment)
+        # the row loaders only link to customers, pets and services already
+        # loaded, rather than fetching them one at a time
+        self.customers.load()
+        self.pets.load()
+        self.services.load()
+        self.load_by_sql(SQL_BOOKING, SQL_BOOKINGITEM, SQL_INVITEM,
+            SQL_INVEXTRA, SQL_PAYMENT)
 
         log.debug(f'Loaded {len(self.bookings)} bookings')
         self.loaded = True
@@ -127,43 +364,93 @@ Select pay_bk_no, pay_date, pay_amount, pay_type from vwpayment_simple"""
             return
 
         log.debug(f'Loading Bookings for customer #{cust_no}')
-        sql_booking = f"""
-Select bk_no, bk_cust_no, bk_create_date, bk_start_datetime, bk_end_datetime,
-bk_gross_amt, bk_paid_amt, bk_status, bk_peak, bk_deluxe, bk_skip_confirm,
-bk_pickup_no from vwbooking
-where bk_cust_no = {cust_no}"""
-        sql_bookingitem = f"""
-Select bi_bk_no, bi_pet_no
-from vwbookingitem_simple
-where bi_cust_no = {cust_no}"""
-        sql_invitem = f"""
-Select ii_bk_no, ii_pet_no, ii_srv_no, ii_quantity, ii_rate
-from vwinvitem where ii_cust_no = {cust_no}"""
-        sql_invextra = f"""
-Select ie_bk_no, ie_desc, ie_unit_price, ie_quantity
-from vwinvextra
-where ie_cust_no = {cust_no}"""
-        sql_payment = f"""
-Select pay_bk_no, pay_date, pay_amount, pay_type
-from vwpayment_simple where pay_cust_no = {cust_no}"""
-
+        sql_booking = f"{SQL_BOOKING}\nwhere bk_cust_no = %s"
+        sql_bookingitem = f"{SQL_BOOKINGITEM}\nwhere bi_cust_no = %s"
+        sql_invitem = f"{SQL_INVITEM}\nwhere ii_cust_no = %s"
+        sql_invextra = f"{SQL_INVEXTRA}\nwhere ie_cust_no = %s"
+        sql_payment = f"{SQL_PAYMENT}\nwhere pay_cust_no = %s"
+
+        self.pets.load_for_customer(cust_no)
+        self.services.load()
         self.load_by_sql(sql_booking, sql_bookingitem, sql_invitem, sql_invextra,
-            sql_payment)
+            sql_payment, (cust_no,))
 
         log.debug(f'Loaded bookings for customer #{cust_no}')
-        self.loaded = True
+
+    def load_many(self, bk_nos):
+        """
+        Load the given bookings, and everything they refer to, in a handful
+        of set-based queries. Bookings already loaded are left alone.
+        """
+        if self.loaded:
+            return
+
+        to_load = set(bk_nos) - self.bookings.keys() - self.missing
+        if not to_load:
+            return
+
+        log.debug(f'Loading {len(to_load)} bookings')
+        self.missing |= self.reload(to_load)
+
+    def reload(self, bk_nos):
+        """
+        (Re)load the given bookings together with their customers, pets,
+        inventory items, extras and payments, patching existing objects in
+        place. Bookings no longer present in the database are dropped.
+        :return: the set of bookings dropped
+        """
+        bk_nos = set(bk_nos)
+        if not bk_nos:
+            return set()
+
+        # reloads can be triggered by a lazy get() while another query's rows
+        # are streaming, so fetch on connections of their own
+        fetch_all = self.env.fetch_all
+        booking_rows = []
+        for keys in in_lists(bk_nos):
+            booking_rows.extend(
+                fetch_all(f"{SQL_BOOKING}\nwhere bk_no in ({keys})"))
+
+        cust_nos = set(row[1] for row in booking_rows)
+        self.customers.reload(cust_nos)
+        self.pets.reload_for_customers(cust_nos)
+        self.services.load()
+
+        self.load_booking_rows(booking_rows)
+        for keys in in_lists(bk_nos):
+            self.load_bookingitem_rows(
+                fetch_all(f"{SQL_BOOKINGITEM}\nwhere bi_bk_no in ({keys})"))
+            self.load_invitem_rows(
+                fetch_all(f"{SQL_INVITEM}\nwhere ii_bk_no in ({keys})"))
+            self.load_invextra_rows(
+                fetch_all(f"{SQL_INVEXTRA}\nwhere ie_bk_no in ({keys})"))
+            self.load_payment_rows(
+                fetch_all(f"{SQL_PAYMENT}\nwhere pay_bk_no in ({keys})"))
+
+        dropped = bk_nos - set(row[0] for row in booking_rows)
+        for bk_no in dropped:
+            booking = self.bookings.pop(bk_no, None)
+            if booking:
+                self.unindex(booking)
+
+        log.debug(f'Reloaded {len(booking_rows)} bookings')
+        return dropped
 
 
 class Payment:
+    __slots__ = ('pay_date', 'amount', 'type')
+
     def __init__(self, pay_date, amount, pay_type):
         self.pay_date = pay_date
         self.amount = amount
         self.type = pay_type
 
 
-from .env import log
+from .env import log, in_lists, intern_str
 
 class ExtraItem:
+    __slots__ = ('desc', 'unit_price', 'quantity')
+
     def __init__(self, desc, unit_price, quantity):
         self.desc = desc
         self.unit_price = unit_price
@@ -171,6 +458,8 @@ class ExtraItem:
 
 
 class InventoryItem:
+    __slots__ = ('pet', 'service', 'quantity', 'rate')
+
     def __init__(self, pet, service, quantity, rate):
         self.pet = pet
         self.service = service
@@ -181,6 +470,11 @@ class InventoryItem:
 class Booking:
     """Representing a PetAdmin Booking"""
 
+    __slots__ = (
+        'no', 'customer', 'pets', 'create_date', 'start_date', 'end_date',
+        'status', 'skip', 'gross_amt', 'paid_amt', 'inv_items', 'extra_items',
+        'payments', 'peak', 'deluxe', 'pickup')
+
     def __init__(self, bk_no):
         self.no = bk_no
         self.customer = None
@@ -197,7 +491,7 @@ class Booking:
         self.payments = []
         self.peak = 0
         self.deluxe = 0
-        self.skip = 0
+        self.pickup = 0
 
     def pet_names(self):
         if len(self.pets) == 1:
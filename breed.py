@@ -1,4 +1,6 @@
-from .env import log
+from .env import log, intern_str
+
+SQL_BREED = 'select breed_no, breed_desc, spec_desc, billcat_desc from vwbreed'
 
 class Breeds:
     """Representing a collection of breeds"""
@@ -20,24 +22,25 @@ class Breeds:
 
         log.debug('Loading Breeds')
 
-        cursor = self.env.get_cursor()
-        sql = 'select breed_no, breed_desc, spec_desc, billcat_desc from vwbreed'
+        self.load_rows(self.env.iter_query(SQL_BREED))
+
+        self.loaded = True
 
-        cursor.execute(sql)
-        for row in cursor:
+    def load_rows(self, rows):
+        for row in rows:
             breed_no = row[0]
             breed = Breed(breed_no)
             self.breeds[breed_no] = breed
-            breed.desc = row[1]
-            breed.spec = row[2]
-            breed.bill_category = row[3]
-
-        self.loaded = True
+            breed.desc = intern_str(row[1])
+            breed.spec = intern_str(row[2])
+            breed.bill_category = intern_str(row[3])
 
 
 class Breed:
     """Representing a particular breed"""
 
+    __slots__ = ('no', 'desc', 'spec', 'bill_category')
+
     def __init__(self, breed_no):
         self.no = breed_no
         self.desc = ''
@@ -0,0 +1,149 @@
+from datetime import date
+from decimal import Decimal
+import numpy as np
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _pence(amount):
+    if amount is None:
+        return 0
+    return int(round(amount * 100))
+
+
+def _ordinal(value):
+    if value is None:
+        return 0
+    if hasattr(value, 'date'):
+        value = value.date()
+    return value.toordinal()
+
+
+class BookingColumns:
+    """
+    A columnar, read-only view of a set of bookings for analytical queries.
+    Amounts are held in pence, dates as proleptic Gregorian ordinals.
+    It is a snapshot: later changes to the bookings are not reflected.
+    Requires numpy.
+    """
+
+    def __init__(self, bookings):
+        bookings = list(bookings)
+        count = len(bookings)
+        self.bk_no = np.fromiter(
+            (b.no for b in bookings), dtype=np.int64, count=count)
+        self.cust_no = np.fromiter(
+            (b.customer.no if b.customer else -1 for b in bookings),
+            dtype=np.int64, count=count)
+        self.start = np.fromiter(
+            (_ordinal(b.start_date) for b in bookings),
+            dtype=np.int32, count=count)
+        self.end = np.fromiter(
+            (_ordinal(b.end_date) for b in bookings),
+            dtype=np.int32, count=count)
+        self.gross_amt = np.fromiter(
+            (_pence(b.gross_amt) for b in bookings),
+            dtype=np.int64, count=count)
+        self.paid_amt = np.fromiter(
+            (_pence(b.paid_amt) for b in bookings),
+            dtype=np.int64, count=count)
+        # dtype=str sizes the strings to the longest status
+        self.status = np.array(
+            [b.status or '' for b in bookings], dtype=str)
+        self.peak = np.fromiter(
+            (bool(b.peak) for b in bookings), dtype=bool, count=count)
+        self.deluxe = np.fromiter(
+            (bool(b.deluxe) for b in bookings), dtype=bool, count=count)
+
+    def __len__(self):
+        return len(self.bk_no)
+
+    def mask(self, start_from=None, start_to=None, status=None,
+             cust_no=None, peak=None, deluxe=None, overlapping=None):
+        """
+        Build a boolean mask selecting bookings matching all given filters.
+        :param start_from:  first start date (inclusive)
+        :param start_to:    last start date (inclusive)
+        :param status:      a status code, or a collection of codes
+        :param cust_no:     a customer number
+        :param peak:        True/False to select peak/off-peak bookings
+        :param deluxe:      True/False to select deluxe/standard bookings
+        :param overlapping: a (from_date, to_date) pair; selects bookings
+                            staying at any time in that range
+        :return: numpy boolean array
+        """
+        selected = np.ones(len(self), dtype=bool)
+        if start_from is not None:
+            selected &= self.start >= _ordinal(start_from)
+        if start_to is not None:
+            selected &= self.start <= _ordinal(start_to)
+        if status is not None:
+            if isinstance(status, str):
+                selected &= self.status == status
+            else:
+                selected &= np.isin(self.status, list(status))
+        if cust_no is not None:
+            selected &= self.cust_no == cust_no
+        if peak is not None:
+            selected &= self.peak == bool(peak)
+        if deluxe is not None:
+            selected &= self.deluxe == bool(deluxe)
+        if overlapping is not None:
+            from_date, to_date = overlapping
+            selected &= (self.start <= _ordinal(to_date)) & \
+                (self.end >= _ordinal(from_date))
+        return selected
+
+    def _select(self, column, mask):
+        if mask is None:
+            return column
+        return column[mask]
+
+    def count(self, mask=None):
+        if mask is None:
+            return len(self)
+        return int(np.count_nonzero(mask))
+
+    def total(self, column='gross_amt', mask=None):
+        """Total of gross_amt or paid_amt over the selected bookings"""
+        values = self._select(getattr(self, column), mask)
+        return Decimal(int(values.sum())).scaleb(-2)
+
+    def outstanding(self, mask=None):
+        """Total outstanding amount over the selected bookings"""
+        values = self._select(self.gross_amt - self.paid_amt, mask)
+        return Decimal(int(values.sum())).scaleb(-2)
+
+    def outstanding_bookings(self, mask=None):
+        """
+        Booking numbers and outstanding amounts (in pence) of the selected
+        bookings with a non-zero balance
+        """
+        balance = self.gross_amt - self.paid_amt
+        selected = balance != 0
+        if mask is not None:
+            selected &= mask
+        return self.bk_no[selected], balance[selected]
+
+    def count_by_start_date(self, mask=None):
+        """Number of selected bookings starting on each date"""
+        ordinals, counts = np.unique(
+            self._select(self.start, mask), return_counts=True)
+        return {
+            date.fromordinal(int(o)): int(c) for o, c in zip(ordinals, counts)}
+
+    def years(self):
+        """Start year of each booking"""
+        days = (self.start.astype(np.int64) - EPOCH_ORDINAL).astype(
+            'datetime64[D]')
+        return days.astype('datetime64[Y]').astype(np.int64) + 1970
+
+    def totals_by_year(self, column='gross_amt', mask=None):
+        """Year-on-year totals of gross_amt or paid_amt, by start year"""
+        years = self._select(self.years(), mask)
+        values = self._select(getattr(self, column), mask)
+        unique_years, inverse = np.unique(years, return_inverse=True)
+        sums = np.bincount(inverse, weights=values, minlength=len(unique_years))
+        return {
+            int(y): Decimal(int(round(s))).scaleb(-2)
+            for y, s in zip(unique_years, sums)}
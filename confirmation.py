@@ -4,11 +4,36 @@ from base64 import b64encode
 from datetime import datetime, date
 from decimal import Decimal
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .env import log, clean_html
 from urllib.request import quote
 from mako.template import Template
 import webbrowser
 
+# compiled templates by (file name, module directory): (mtime, template)
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(file_name, module_directory=None):
+    """
+    The Mako template in file_name, compiled once per process and again only
+    when the file changes. With module_directory, Mako also keeps compiled
+    modules on disk, so a new process can skip compilation as well.
+    """
+    mtime = path.getmtime(file_name)
+    key = (file_name, module_directory)
+    with _templates_lock:
+        cached = _templates.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        template = Template(
+            filename=file_name, module_directory=module_directory)
+        _templates[key] = (mtime, template)
+        return template
+
 
 class ArgsWrapper():
     def __init__(self, dict):
@@ -53,8 +78,23 @@ def handle_remote_confirmation(data):
 
 def confirm_all(
         petadmin, report_parameters, action, asofdate=None,
-        audit_start=0, additional_text='', forced_subject=''
+        audit_start=0, additional_text='', forced_subject='',
+        working_set=False, workers=1
         ):
+    """
+    Generate confirmations for all bookings with recent audit events.
+    With working_set, only the audited bookings (and their customers, pets,
+    items and payments) are loaded, rather than the whole of PetAdmin.
+    With workers > 1 and the email action, confirmations are rendered and
+    written in a thread pool, while emails and database records are still
+    sent from this thread, in candidate order.
+    audit_start is no longer supported; its query compared aud_date with the
+    audit number and never ran.
+    """
+    if audit_start > 0:
+        log.error('confirm_all: audit_start is not supported, use asofdate')
+        return
+
     confirmation_candidates = {}
     conf_time = datetime.now()
 
@@ -65,7 +105,8 @@ def confirm_all(
     sql = 'Execute padd_booking_fee_new'
     env.execute(sql)
 
-    petadmin.load()
+    if not working_set:
+        petadmin.load()
 
     # next read all past emails sent, to safeguard against double-sending
 
@@ -91,22 +132,16 @@ def confirm_all(
             past_messages[bk_no] = []
         past_messages[bk_no].append((hist_date, destination, subject))
 
+    params = None
     if asofdate:
-        sql = f"""
+        sql = """
         select a.bk_no, aud_type, aud_action, aud_amount, aud_date,
             aud_booking_count, aud_confirm from vwaudit a
         join vwbooking b on a.bk_no = b.bk_no
         where b.bk_start_date > GETDATE() and
-            aud_date >= '{asofdate}' order by b.bk_start_date
-        """
-    elif audit_start > 0:
-        sql = """
-        select b.bk_no, aud_type, aud_action, aud_amount, aud_date,
-            aud_booking_count, aud_confirm from vwaudit_orphan a
-        join vwbooking b on a.aud_key = b.bk_no
-        where b.bk_start_date > GETDATE() and aud_date >= '{audit_start}'
-        order by b.bk_start_date
+            aud_date >= %s order by b.bk_start_date
         """
+        params = (asofdate,)
     else:
         sql = """
         select a.bk_no, aud_type, aud_action, aud_amount, aud_date,
@@ -118,12 +153,13 @@ def confirm_all(
         """
 
     try:
-        cursor.execute(sql)
+        rows = env.query(sql, params).fetchall()
     except Exception as e:
         log.exception("Exception executing '%s': %s", sql, str(e))
         return
 
-    rows = cursor.fetchall()
+    if working_set:
+        petadmin.load_bookings(row[0] for row in rows)
 
     for row in rows:
         bk_no = row[0]
@@ -172,11 +208,12 @@ def confirm_all(
     env.clear_key()
     log.info('Confirming %d candidates', len(confirmation_candidates))
     if len(confirmation_candidates) > 0:
-        conf_time_str = conf_time.strftime('%Y%m%d %H:%M:%S')
-        sql = (f"Insert into tblconfirm (conf_time, conf_candidates) values"
-               f"('{conf_time_str}', {len(confirmation_candidates)})")
+        sql = ("Insert into tblconfirm (conf_time, conf_candidates) values"
+               "(%s, %s)")
         try:
-            env.execute(sql)
+            env.execute(
+                sql, params=(conf_time.replace(microsecond=0),
+                             len(confirmation_candidates)))
         except Exception as e:
             log.exception("Exception executing '%s': %s", sql, str(e))
             return
@@ -195,25 +232,51 @@ def confirm_all(
             f'Created confirmation record #{conf_no} with'
             f' {len(confirmation_candidates)} candidates')
 
-        successfuls = 0
-        for cc in confirmation_candidates.values():
-            env.set_key(cc.booking.no, 'B')
-            log.debug('Processing confirmation candidate')
+        candidates = list(confirmation_candidates.values())
+        for cc in candidates:
             cc.conf_no = conf_no
-            try:
-                cc.generate_confirmation(report_parameters, action)
-                log.debug('Generate confirmation completed successfully')
-                successfuls += 1
-            except Exception as e:
-                log.exception(
-                    f'Exception when generating confirmation for booking '
-                    f'{cc.booking.no}: {e}')
+
+        # display and review are interactive, so stay serial
+        parallel = workers > 1 and action == 'email'
+        with ThreadPoolExecutor(
+                max_workers=workers if parallel else 1) as executor:
+            if parallel:
+                renders = [
+                    executor.submit(cc.render, report_parameters, action)
+                    for cc in candidates]
+
+            successful = []
+            for i, cc in enumerate(candidates):
+                env.set_key(cc.booking.no, 'B')
+                log.debug('Processing confirmation candidate')
+                try:
+                    if parallel:
+                        rendered = renders[i].result()
+                        if rendered:
+                            cc.deliver(rendered, action)
+                    else:
+                        cc.generate_confirmation(report_parameters, action)
+                    log.debug('Generate confirmation completed successfully')
+                    successful.append(cc)
+                except Exception as e:
+                    log.exception(
+                        f'Exception when generating confirmation for booking '
+                        f'{cc.booking.no}: {e}')
         env.clear_key()
+
+        # with an outbox, count only what has actually been delivered, and
+        # let the confactions be recorded before pmaintenance runs
+        if env.outbox:
+            env.outbox.dispatch()
+        successfuls = sum(
+            1 for cc in successful
+            if cc.spooled is None or env.outbox.was_delivered(cc.spooled))
         sql = (
-            f'Update tblconfirm set conf_successfuls = {successfuls}'
-            f' where conf_no = {conf_no}')
-        env.execute(sql)
+            'Update tblconfirm set conf_successfuls = %s'
+            ' where conf_no = %s')
+        env.writer.execute(sql, (successfuls, conf_no))
 
+    env.writer.flush()
     sql = 'Execute pmaintenance'
     try:
         env.execute(sql)
@@ -245,16 +308,27 @@ def process_booking(bk_no, args, pa, action, rp, additional_text='',
     return(cc.generate_confirmation(rp, action))
 
 
+def confaction(
+        bk_no, deposit_amount, subject, file_name, conf_no=0, email=''):
+    """The stored procedure call recording a sent confirmation"""
+    return ('pinsert_confaction', (
+        conf_no, bk_no, '', subject, file_name, deposit_amount, email))
+
+
 def handle_confirmation(
         env, bk_no, deposit_amount, subject, file_name,
         conf_no=0, email=''):
-    sql = f"Execute pinsert_confaction {conf_no}, {bk_no}, '', '{subject}'" \
-          f", '{file_name}', {deposit_amount}, '{email}'"
-    env.execute(sql)
+    """Record a sent confirmation; written behind, through env.writer"""
+    env.writer.call(*confaction(
+        bk_no, deposit_amount, subject, file_name, conf_no, email))
 
 
 class ReportParameters:
-    def __init__(self, env):
+    # base64 image data shared by all instances, by file: (mtime, data)
+    assets = {}
+    assets_lock = threading.Lock()
+
+    def __init__(self, env, embed_images=True):
         self.report = path.join(env.image_folder, "Confirmation.html")
         self.report_txt = path.join(env.image_folder, "Confirmation.txt")
         self.provisional_report = \
@@ -265,23 +339,36 @@ class ReportParameters:
         self.deluxe_logo_file = \
             path.join(env.image_folder, "deluxe_logo_2.png")
         self.pay_deposit_file = path.join(env.image_folder, "paydeposit.png")
+        self.module_directory = getattr(env, 'template_cache_folder', None)
         self.logo_code = None
         self.deluxe_logo_code = None
         self.deposit_icon = None
+        self.embed_images = embed_images
         self.past_messages = []
 
-    # def read_images(self):
-    #     with open(self.logo_file, "rb") as f:
-    #         data = f.read()
-    #         self.logo_code = b64encode(data)
+    @classmethod
+    def asset(cls, file_name):
+        """
+        The base64 encoding of file_name as text, read once per process and
+        again only when the file changes
+        """
+        mtime = path.getmtime(file_name)
+        with cls.assets_lock:
+            cached = cls.assets.get(file_name)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+        with open(file_name, "rb") as f:
+            data = b64encode(f.read()).decode('ascii')
 
-    #     with open(self.deluxe_logo_file, "rb") as f:
-    #         data = f.read()
-    #         self.deluxe_logo_code = b64encode(data)
+        with cls.assets_lock:
+            cls.assets[file_name] = (mtime, data)
+        return data
 
-    #     with open(self.pay_deposit_file, "rb") as f:
-    #         data = f.read()
-    #         self.deposit_icon = b64encode(data)
+    def read_images(self):
+        self.logo_code = self.asset(self.logo_file)
+        self.deluxe_logo_code = self.asset(self.deluxe_logo_file)
+        self.deposit_icon = self.asset(self.pay_deposit_file)
 
     @staticmethod
     def get_deposit_url(bk_no, deposit_amount, pet_names, customer, expiry=0):
@@ -340,6 +427,8 @@ class ConfirmationCandidate:
         self.deposit = True
         self.deposit_amount = Decimal("0.00")
         self.conf_no = 0
+        # name of the spooled email, when sent through an outbox
+        self.spooled = None
         self.payment_amount = Decimal("0.00")
         self.payment_date = None
         self.title = ''
@@ -453,12 +542,18 @@ class ConfirmationCandidate:
 
         if not report_parameters:
             report_parameters = ReportParameters(self.env)
-#            report_parameters.read_images()
 
+        if report_parameters.embed_images:
+            report_parameters.read_images()
+
+        start = time.perf_counter()
         if body_format == 'html':
-            mytemplate = Template(filename=report_parameters.report)
+            mytemplate = get_template(
+                report_parameters.report, report_parameters.module_directory)
         else:
-            mytemplate = Template(filename=report_parameters.report_txt)
+            mytemplate = get_template(
+                report_parameters.report_txt,
+                report_parameters.module_directory)
 
         self.paid = self.booking.paid_amt != Decimal(0.00)
 
@@ -470,9 +565,24 @@ class ConfirmationCandidate:
             deposit_url=self.deposit_url
             )
 
+        log.debug(
+            f'Rendered {body_format} confirmation for booking '
+            f'{self.booking.no} in {time.perf_counter() - start:.3f}s')
         return body
 
     def generate_confirmation(self, report_parameters, action):
+        rendered = self.render(report_parameters, action)
+        if rendered:
+            return self.deliver(rendered, action)
+
+    def render(self, report_parameters, action='email'):
+        """
+        Prepare the confirmation, render its html and text bodies and write
+        them to the confirmations folder. Sends nothing, so may run in a
+        worker thread.
+        :return: (file_name, text_file_name, body, body_txt), or None if
+                 the booking is missing or skipped
+        """
         if not self.booking:
             log.error('Missing booking')
             return
@@ -508,6 +618,13 @@ class ConfirmationCandidate:
         f.write(body)
         f.close()
 
+        return file_name, text_file_name, body, body_txt
+
+    def deliver(self, rendered, action):
+        """Display, review and/or email a rendered confirmation"""
+        file_name, text_file_name, body, body_txt = rendered
+        fout = path.join(self.env.confirmations_folder, file_name)
+
         send_email = False
         if action == 'email':
             send_email = True
@@ -532,21 +649,23 @@ class ConfirmationCandidate:
                 else:
                     subject = f'{self.title} #{self.booking.no}'
 
-                self.env.send_email(
-                    self.booking.customer.email, body,
-                    subject, body_txt
-                    )
-
                 try:
                     if not self.deposit:
                         self.deposit_amount = 0.0
-                    handle_confirmation(
-                        self.env, self.booking.no, self.deposit_amount,
+                    after = confaction(
+                        self.booking.no, self.deposit_amount,
                         subject, file_name, self.conf_no,
                         self.booking.customer.email
                         )
                 except Exception as e:
                     log.exception(str(e))
+                    after = None
+
+                # the confirmation is recorded once the email is delivered
+                self.spooled = self.env.send_email(
+                    self.booking.customer.email, body,
+                    subject, body_txt, after=after
+                    )
 
         log.debug('Confirmation complete')
         return (file_name, text_file_name)
@@ -1,36 +1,56 @@
-from .env import log
+from .env import log, in_lists, intern_str
 
+SQL_CUSTOMER = (
+    "Select cust_no, cust_surname, cust_forename, cust_addr1, "
+    "cust_addr2, cust_addr3, cust_postcode, cust_telno_home, "
+    "cust_email, cust_discount, cust_telno_mobile, cust_title, "
+    "cust_nodeposit, cust_deposit_requested, cust_nosms "
+    "from vwcustomer"
+)
 
 class Customers:
     def __init__(self, env):
         self.customers = {}
         self.env = env
         self.loaded = False
+        # when lazy, get() fetches a missing customer on demand
+        self.lazy = False
+        self.missing = set()
 
     def get(self, cust_no):
         if cust_no in self.customers:
             return self.customers[cust_no]
-        else:
-            return None
 
-    def load_by_sql(self, sql):
-        cursor = self.env.get_cursor()
+        if self.lazy and not self.loaded and cust_no not in self.missing:
+            self.load_one(cust_no)
+            if cust_no in self.customers:
+                return self.customers[cust_no]
+            self.missing.add(cust_no)
+
+        return None
 
-        cursor.execute(sql)
-        for row in cursor:
+    def load_by_sql(self, sql, params=None):
+        # streamed on a connection of its own, so that queries made while
+        # the rows are processed do not cut the stream short
+        self.load_rows(self.env.iter_query(sql, params))
+
+    def load_rows(self, rows):
+        for row in rows:
             cust_no = row[0]
-            customer = Customer(cust_no)
+            customer = self.customers.get(cust_no)
+            if customer is None:
+                customer = Customer(cust_no)
             customer.surname = row[1]
             customer.forename = row[2]
             customer.addr1 = row[3]
             customer.addr2 = row[4]
-            customer.addr3 = row[5]
+            customer.addr3 = intern_str(row[5])
             customer.postcode = row[6]
             customer.telno_home = row[7]
             customer.email = row[8]
             customer.discount = row[9]
             customer.telno_mobile = row[10]
-            customer.title = row[11]
+            customer.title = intern_str(row[11])
             customer.nodeposit = row[12]
             customer.deposit_requested = row[13]
             customer.nosms = row[14]
@@ -43,15 +63,7 @@ class Customers:
 
         log.debug('Loading Customers')
 
-        sql = (
-            "Select cust_no, cust_surname, cust_forename, cust_addr1, "
-            "cust_addr2, cust_addr3, cust_postcode, cust_telno_home, "
-            "cust_email, cust_discount, cust_telno_mobile, cust_title, "
-            "cust_nodeposit, cust_deposit_requested, cust_nosms "
-            "from vwcustomer"
-        )
-
-        self.load_by_sql(sql)
+        self.load_by_sql(SQL_CUSTOMER)
 
         log.debug(f'Loaded {len(self.customers)} customers')
         self.loaded = True
@@ -62,22 +74,29 @@ class Customers:
 
         log.debug(f'Loading customer #{cust_no}')
 
-        sql = (
-            "Select cust_no, cust_surname, cust_forename, "
-            "cust_addr1, cust_addr2, cust_addr3, cust_postcode, "
-            "cust_telno_home, cust_email, cust_discount, "
-            "cust_telno_mobile, cust_title, cust_nodeposit, "
-            "cust_deposit_requested, cust_nosms "
-            f"from vwcustomer where cust_no = {cust_no}")
+        sql = f"{SQL_CUSTOMER} where cust_no = %s"
 
-        self.load_by_sql(sql)
+        # lazy loads can happen while another query's rows are streaming,
+        # so use a connection of their own
+        self.load_rows(self.env.fetch_all(sql, (cust_no,)))
 
         log.debug(f'Loaded customer {cust_no}')
 
+    def reload(self, cust_nos):
+        """(Re)load the given customers, updating existing objects in place"""
+        for keys in in_lists(cust_nos):
+            self.load_rows(self.env.fetch_all(
+                f"{SQL_CUSTOMER} where cust_no in ({keys})"))
+
 
 class Customer:
     """Representing a PetAdmin Customer"""
 
+    __slots__ = (
+        'no', 'pets', 'surname', 'forename', 'addr1', 'addr2', 'addr3',
+        'postcode', 'telno_home', 'email', 'discount', 'telno_mobile', 'title',
+        'nodeposit', 'deposit_requested', 'nosms', 'notes')
+
     def __init__(self, cust_no):
         self.no = cust_no
         self.pets = []
@@ -94,6 +113,7 @@ class Customer:
         self.title = ''
         self.nodeposit = 0
         self.deposit_requested = 0
+        self.nosms = 0
         self.notes = ''
 
     def add_pet(self, pet):
@@ -127,10 +147,7 @@ class Customer:
         return full_address
 
     def write(self, env):
-        sql = \
-            f"execute pcreate_customer '{self.surname}', '{self.forename}', " \
-            f"'{self.addr1}', '{self.addr3}', '{self.postcode}', " \
-            f"'{self.telno_home}', '{self.telno_mobile}', '{self.email}', " \
-            f"'{self.notes}'"
-
-        env.execute(sql)
+        env.call('pcreate_customer', (
+            self.surname, self.forename, self.addr1, self.addr3,
+            self.postcode, self.telno_home, self.telno_mobile, self.email,
+            self.notes))
@@ -5,13 +5,22 @@ import pymssql
 import smtplib
 import logging
 import logging.handlers
+import atexit
+import queue
 import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
 from os import getenv
+from uuid import uuid4
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
-from datetime import datetime
+from datetime import date, datetime
 from pypa.settings import get_settings
 
 assert(sys.platform == 'win32')
@@ -24,59 +33,573 @@ if not ENVIRONMENT:
 
 
 TAG_RE = re.compile(r'<[^>]+>')
+IN_LIST_SIZE = 1000
+FETCH_SIZE = 1000
+POOL_SIZE = 8
+# seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 60
+# seconds a connection may sit idle before it is pinged on reuse
+PING_AFTER = 60
+BATCH_SIZE = 100
+LOG_QUEUE_SIZE = 10000
+# plog takes 7 parameters; SQL Server allows 2100 per batch
+LOG_BATCH_SIZE = 250
+# a batch is written as statements of these fixed sizes, so SQL Server
+# caches one plan per size rather than one per batch length
+LOG_BATCH_SHAPES = (250, 50, 10, 1)
+DIGEST_SIZE = 1000
+DIGEST_INTERVAL = 300
+SMTP_WORKERS = 4
+SMTP_RETRIES = 2
+OUTBOX_INTERVAL = 60
 
 
 def clean_html(html_text: str) -> str:
     return TAG_RE.sub('', html_text)
 
 
+def in_lists(keys, size=IN_LIST_SIZE):
+    """
+    Split integer keys into comma separated lists suitable for an SQL
+    'in (...)' clause, at most size keys each
+    """
+    keys = sorted(set(int(key) for key in keys))
+    for i in range(0, len(keys), size):
+        yield ', '.join(str(key) for key in keys[i:i + size])
+
+
+def intern_str(value):
+    """
+    Intern strings that repeat across many loaded objects (species, status,
+    codes and descriptions), so each distinct value is stored once
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def sql_type(value):
+    """SQL Server type used to declare a parameter holding value"""
+    if isinstance(value, bool):
+        return 'bit'
+    if isinstance(value, int):
+        return 'int' if -2 ** 31 <= value < 2 ** 31 else 'bigint'
+    if isinstance(value, Decimal):
+        return 'decimal(19, 4)'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, datetime):
+        return 'datetime2'
+    if isinstance(value, date):
+        return 'date'
+    if isinstance(value, str) and value.isascii():
+        # varchar, so comparisons with varchar columns need no conversion
+        return 'varchar(max)' if len(value) > 8000 else 'varchar(8000)'
+    if isinstance(value, str) and len(value) > 4000:
+        return 'nvarchar(max)'
+    return 'nvarchar(4000)'
+
+
+def parameterized(sql, params):
+    """
+    Turn sql with %s placeholders into an sp_executesql call, so that SQL
+    Server compiles one plan per statement and reuses it for every set of
+    values, rather than caching a single-use plan per literal.
+    :return: (sql, params) to pass to cursor.execute
+    """
+    if not params:
+        return sql, None
+
+    params = tuple(params)
+    tokens = re.split('(%[%s])', sql)
+    if tokens.count('%s') != len(params):
+        raise ValueError(
+            f'{len(params)} parameters given for {tokens.count("%s")} '
+            f'placeholders in {sql}')
+
+    numbers = iter(range(len(params)))
+    statement = ''.join(
+        f'@p{next(numbers)}' if token == '%s' else
+        '%' if token == '%%' else token
+        for token in tokens)
+    declarations = ', '.join(
+        f'@p{i} {sql_type(value)}' for i, value in enumerate(params))
+    assignments = ', '.join(f'@p{i} = %s' for i in range(len(params)))
+
+    return (
+        f'exec sp_executesql %s, %s, {assignments}',
+        (statement, declarations) + params)
+
+
 class DatabaseHandler(logging.Handler):
-    def __init__(self, env):
+    """
+    Writes log records to the database through plog. Records are queued and
+    written by a background thread, up to batch_size per round trip, so
+    logging never waits on the database.
+    When the queue is full, records are dropped and the number dropped is
+    logged once there is room again; with block set, the logging thread
+    waits for room instead.
+    """
+
+    def __init__(self, env, queue_size=LOG_QUEUE_SIZE,
+                 batch_size=LOG_BATCH_SIZE, block=False):
         logging.Handler.__init__(self)
         self.env = env
+        self.batch_size = batch_size
+        self.block = block
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        # emit runs under the handler lock, which may be held while
+        # blocked on a full queue, so the worker must not need it
+        self.state_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self._run, name='DatabaseHandler', daemon=True)
+        self.thread.start()
 
     def emit(self, record):
-        msg = self.format(record)
-        levelname = record.levelname
-        filename = record.filename
-        lineno = record.lineno
-        sql = f"""
-Execute plog '{msg.replace("'", "''")}', '{levelname}', '{self.env.context}',
-{self.env.key}, '{self.env.key_type}',
-'{filename}', {lineno}"""
+        # the writer's own failures must not feed back into the queue
+        if self.closed or threading.current_thread() is self.thread:
+            return
+
+        try:
+            entry = (
+                self.format(record), record.levelname, self.env.context,
+                self.env.key, self.env.key_type, record.filename,
+                record.lineno)
+            self.queue.put(entry, block=self.block)
+        except queue.Full:
+            with self.state_lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Block until every record queued so far has been written"""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        with self.state_lock:
+            closed, self.closed = self.closed, True
+        if not closed:
+            self.queue.put(None)
+            self.thread.join()
+        logging.Handler.close(self)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            entries = [entry for entry in batch if entry is not None]
+            with self.state_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                entries.append((
+                    f'{dropped} log records dropped (queue full)', 'WARNING',
+                    self.env.context, 0, '', 'env.py', 0))
+
+            if entries:
+                self._write(entries)
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def _write(self, entries):
+        try:
+            with self.env.pool.connection() as conn:
+                cur = conn.cursor()
+                start = 0
+                for size in LOG_BATCH_SHAPES:
+                    sql = ';\n'.join(
+                        ['exec plog %s, %s, %s, %s, %s, %s, %s'] * size)
+                    while len(entries) - start >= size:
+                        params = [
+                            value for entry in entries[start:start + size]
+                            for value in entry]
+                        cur.execute(*parameterized(sql, params))
+                        start += size
+                # the log is kept in test runs too
+                conn.commit()
+        except Exception:
+            self.handleError(None)  # no particular record
 
-        self.env.execute(sql)
 
+class DigestSMTPHandler(logging.Handler):
+    """
+    Emails log records as a digest, sent from a background thread once
+    capacity distinct messages are pending or interval seconds have passed
+    since the first of them, so logging never waits on the mail server.
+    Repeats of a message are counted rather than listed again.
+    flush() sends whatever is pending and waits for it to go.
+    """
 
-class BufferingSMTPHandler(logging.handlers.BufferingHandler):
-    def __init__(self, env):
-        logging.handlers.BufferingHandler.__init__(self, 1000)
+    def __init__(self, env, capacity=DIGEST_SIZE, interval=DIGEST_INTERVAL):
+        logging.Handler.__init__(self)
         self.env = env
-        self.mailhost = env.email_host
-        self.mailport = None
-        self.fromaddr = env.email_user
         self.toaddrs = env.email_logs
         self.subject = 'Python Log'
+        self.capacity = capacity
+        self.interval = interval
         self.setFormatter(logging.Formatter(
             "%(asctime)s %(levelname)-7s %(message)s"))
 
+        # (levelname, message) -> [first formatted line, count]
+        self.entries = {}
+        self.first = None
+        self.requested = self.taken = self.served = 0
+        self.closed = False
+        self.wakeup = threading.Condition()
+        self.thread = threading.Thread(
+            target=self._run, name='DigestSMTPHandler', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        if threading.current_thread() is self.thread:
+            return
+
+        try:
+            key = (record.levelname, record.getMessage())
+            with self.wakeup:
+                if self.closed:
+                    return
+                entry = self.entries.get(key)
+                if entry:
+                    entry[1] += 1
+                    return
+                self.entries[key] = [self.format(record), 1]
+                if self.first is None:
+                    self.first = time.monotonic()
+                    self.wakeup.notify()
+                elif len(self.entries) >= self.capacity:
+                    self.wakeup.notify()
+        except Exception:
+            self.handleError(record)
+
     def flush(self):
-        if len(self.buffer) > 0:
-            try:
-                body = ''
-                for record in self.buffer:
-                    s = self.format(record)
-                    body += s + "<br/>"
+        with self.wakeup:
+            self.requested += 1
+            request = self.requested
+            self.wakeup.notify_all()
+            while self.served < request and self.thread.is_alive():
+                self.wakeup.wait(1)
+
+    def close(self):
+        with self.wakeup:
+            self.closed = True
+            self.wakeup.notify_all()
+        self.thread.join()
+        logging.Handler.close(self)
+
+    def _due(self):
+        return self.closed or self.requested > self.taken or \
+            len(self.entries) >= self.capacity or \
+            (self.first is not None and
+             time.monotonic() - self.first >= self.interval)
+
+    def _run(self):
+        while True:
+            with self.wakeup:
+                while not self._due():
+                    timeout = None
+                    if self.first is not None:
+                        timeout = self.first + self.interval - time.monotonic()
+                    self.wakeup.wait(timeout)
+                entries, self.entries = self.entries, {}
+                self.first = None
+                self.taken = self.requested
+                closing = self.closed
+
+            if entries:
+                self._send(entries.values())
+
+            with self.wakeup:
+                self.served = self.taken
+                self.wakeup.notify_all()
+            if closing:
+                return
+
+    def _send(self, entries):
+        lines = [
+            line if count == 1 else f'{line} (repeated {count} times)'
+            for line, count in entries]
+        try:
+            self.env.send_email(
+                self.toaddrs, '<br/>'.join(lines), self.subject,
+                '\n'.join(lines), True)
+        except Exception:
+            self.handleError(None)  # no particular record
+
+
+class ThreadConnection:
+    """
+    A connection checked out for one thread. It goes back to the pool when
+    released, or when the thread ends and its thread-local data is dropped.
+    """
+
+    def __init__(self, pool, conn):
+        self.conn = conn
+        self.last_used = time.monotonic()
+        self.finalizer = weakref.finalize(self, pool.release, conn)
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of database connections.
+    Connections are checked out for exclusive use and handed back with
+    release(). A connection idle for more than ping_after seconds is pinged
+    before reuse and transparently replaced if dead.
+    """
+
+    def __init__(self, connect, max_size=POOL_SIZE, ping_after=PING_AFTER):
+        self.connect = connect
+        self.max_size = max_size
+        self.ping_after = ping_after
+        self.idle = []
+        self.size = 0
+        self.closed = False
+        self.available = threading.Condition()
+        self.stats = {
+            'created': 0, 'reused': 0, 'reconnects': 0, 'waits': 0,
+            'broken': 0}
+
+    def acquire(self, timeout=POOL_TIMEOUT):
+        with self.available:
+            while True:
+                if self.closed:
+                    raise RuntimeError('Connection pool is closed')
+                if self.idle:
+                    conn, last_used = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    conn = last_used = None
+                    break
+                self.stats['waits'] += 1
+                if not self.available.wait(timeout):
+                    raise TimeoutError('Timed out waiting for a connection')
 
-                self.env.send_email(
-                    self.toaddrs, body, self.subject, body, True)
+        try:
+            if conn is None:
+                conn = self.connect()
+                self._count('created')
+            elif time.monotonic() - last_used > self.ping_after and \
+                    not self.is_alive(conn):
+                self._close(conn)
+                conn = self.connect()
+                self._count('reconnects')
+            else:
+                self._count('reused')
+        except Exception:
+            with self.available:
+                self.size -= 1
+                self.available.notify()
+            raise
+
+        return conn
+
+    def release(self, conn, broken=False):
+        """
+        Return a checked out connection. Uncommitted work is rolled back.
+        Broken connections are closed and their slot freed.
+        """
+        if not broken:
+            try:
+                conn.rollback()
             except Exception:
-                self.handleError(None)  # no particular record
-            self.buffer = []
+                broken = True
+
+        with self.available:
+            if broken or self.closed:
+                if broken:
+                    self.stats['broken'] += 1
+                self.size -= 1
+                self._close(conn)
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.available.notify()
+
+    @contextmanager
+    def connection(self, timeout=POOL_TIMEOUT):
+        conn = self.acquire(timeout)
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = not self.is_alive(conn)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def _count(self, stat):
+        with self.available:
+            self.stats[stat] += 1
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            cur = conn.cursor()
+            cur.execute('select 1')
+            cur.fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def statistics(self):
+        with self.available:
+            stats = dict(self.stats)
+            stats['size'] = self.size
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = self.size - len(self.idle)
+            stats['max_size'] = self.max_size
+        return stats
+
+    def close(self):
+        with self.available:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.available.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+
+class BatchWriter:
+    """
+    A write-behind queue for statements whose outcome the caller does not
+    wait on. Writes are applied in order by a background thread, with
+    whatever has queued up meanwhile (up to batch_size) sharing a single
+    transaction. flush() blocks until everything queued has been written;
+    close() flushes and stops the thread, and is also run at exit.
+
+    In test environments nothing is committed, so an uncommitted row on the
+    caller's connection could block the writer's transaction; writes are
+    then applied directly instead.
+    """
+
+    def __init__(self, env, batch_size=BATCH_SIZE):
+        self.env = env
+        self.batch_size = batch_size
+        self.deferred = not env.is_test
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def execute(self, sql, params=None):
+        self.put((False, sql, params))
+
+    def call(self, procedure, params=()):
+        self.put((True, procedure, tuple(params)))
+
+    def put(self, write):
+        if not self.deferred:
+            self.apply_now(write)
+            return
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Batch writer is closed')
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='BatchWriter', daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+        self.queue.put(write)
+
+    def apply_now(self, write):
+        is_call, statement, params = write
+        if is_call:
+            self.env.call(statement, params)
+        else:
+            self.env.execute(statement, params=params)
+
+    def flush(self):
+        """Block until every write queued so far has been applied"""
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = [write for write in batch if write is not None]
+            if writes:
+                self._write(writes)
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    @staticmethod
+    def _apply(cur, write):
+        is_call, statement, params = write
+        if is_call:
+            cur.callproc(statement, params)
+        else:
+            cur.execute(*parameterized(statement, params))
+
+    def _write(self, writes):
+        try:
+            with self.env.pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    for write in writes:
+                        self._apply(cur, write)
+                    conn.commit()
+                    return
+                except Exception:
+                    conn.rollback()
+
+                # one bad statement should not cost the rest of the batch
+                for write in writes:
+                    try:
+                        self._apply(cur, write)
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        log.error(f'Error writing {write[1]} {write[2]}: {e}')
+        except Exception as e:
+            log.error(f'Error writing {len(writes)} queued statements: {e}')
+
+
+def _smtp_alive(session):
+    try:
+        return session.noop()[0] == 250
+    except Exception:
+        return False
 
 
 class Environment:
-    def __init__(self, context, env_type=''):
+    def __init__(self, context, env_type='', pool_size=POOL_SIZE):
         if env_type:
             ENVIRONMENT = env_type
         else:
@@ -91,12 +614,20 @@ class Environment:
         self.platform = sys.platform
 
         self.smtp_server = None
-        self.connection = None
+        # the shared session is used by the log digest thread too
+        self.smtp_lock = threading.Lock()
+        self.outbox = None
+        self.pool = ConnectionPool(self.connect, pool_size)
+        # each thread keeps a connection from the pool for get_connection
+        self.local = threading.local()
         self.is_test = (env_type != 'prod')
         self.smtp_handler = None
+        self.db_handler = None
         self.context = context
         self.key = 0
         self.key_type = ''
+        self.fetch_size = FETCH_SIZE
+        self.writer = BatchWriter(self)
 
     def __getattr__(self, attr):
         if attr in self.settings:
@@ -117,16 +648,12 @@ class Environment:
         self.key_type = ''
 
     def get_smtp_server(self):
-        if self.smtp_server:
-            if self.smtp_server.noop()[0] == 250:
-                return self.smtp_server
-            self.smtp_server.connect(self.email_host)
-        else:
-            self.smtp_server = smtplib.SMTP_SSL(
-                self.email_host, 465, timeout=120)
-        self.smtp_server.ehlo()
-        self.smtp_server.login(self.email_user, self.email_pwd)
-
+        """
+        The shared SMTP session, opened on first use. It is not checked
+        here; send_email replaces it only once a send fails.
+        """
+        if self.smtp_server is None:
+            self.smtp_server = self.new_smtp_session()
         return self.smtp_server
 
     def configure_logger(self, logger):
@@ -135,7 +662,7 @@ class Environment:
 
         debug = (self.env_type in ('qa', 'dev'))
 
-        self.smtp_handler = BufferingSMTPHandler(self)
+        self.smtp_handler = DigestSMTPHandler(self)
         stream_handler = logging.StreamHandler()
         if not self.smtp_server:
             try:
@@ -149,12 +676,12 @@ class Environment:
         stream_handler.setFormatter(formatter)
         self.smtp_handler.setFormatter(formatter)
 
-        db_handler = DatabaseHandler(self)
+        self.db_handler = DatabaseHandler(self)
 
         logger.addHandler(file_handler)
         logger.addHandler(self.smtp_handler)
         logger.addHandler(stream_handler)
-        logger.addHandler(db_handler)
+        logger.addHandler(self.db_handler)
 
         if self.is_test or debug:
             logger.setLevel(logging.DEBUG)
@@ -163,37 +690,130 @@ class Environment:
             logger.setLevel(logging.INFO)
             self.smtp_handler.setLevel(logging.WARNING)
 
+    def connect(self):
+        return pymssql.connect(
+            server=self.db_server, user=self.db_user, password=self.db_pwd,
+            database=self.db_database)
+
     def get_connection(self):
-        if not self.connection:
+        """
+        The calling thread's connection, checked out from the pool on first
+        use and handed back when the thread ends. If it has been idle a
+        while it is pinged first and replaced if it has died.
+        """
+        checked_out = getattr(self.local, 'connection', None)
+        if checked_out is not None and \
+                time.monotonic() - checked_out.last_used > \
+                self.pool.ping_after and \
+                not self.pool.is_alive(checked_out.conn):
+            checked_out.finalizer.detach()
+            self.pool.release(checked_out.conn, broken=True)
+            checked_out = None
+
+        if checked_out is None:
             # if self.platform == 'win32':
-            self.connection = pymssql.connect(
-                server=self.db_server, user=self.db_user, password=self.db_pwd,
-                database=self.db_database)
+            checked_out = ThreadConnection(self.pool, self.pool.acquire())
             #             else:
             #                 driver = 'SQL SERVER'
             #                 self.connection = pyodbc.connect(
             # f"""DRIVER={driver};SERVER={self.db_server};DATABASE={self.db_database};
             # UID={self.db_user};PWD={self.db_pwd}"""
             #                     )
+            self.local.connection = checked_out
 
-        return self.connection
+        checked_out.last_used = time.monotonic()
+        return checked_out.conn
+
+    def release_connection(self):
+        """Hand the calling thread's connection back to the pool"""
+        checked_out = getattr(self.local, 'connection', None)
+        if checked_out is not None:
+            self.local.connection = None
+            checked_out.finalizer()
+
+    def pool_statistics(self):
+        return self.pool.statistics()
 
     def get_cursor(self):
         conn = self.get_connection()
         cur = conn.cursor()
         return cur
 
-    def execute(self, sql, commit=None):
+    def query(self, sql, params=None):
+        """
+        Execute sql on the thread's connection and return the cursor.
+        Values go in params, with %s placeholders in sql.
+        """
+        cur = self.get_cursor()
+        cur.execute(*parameterized(sql, params))
+        return cur
+
+    def fetch_all(self, sql, params=None):
+        """Run sql on a connection of its own and return all rows.
+
+        Used by concurrent loaders, which cannot share a connection.
+        In test environments nothing is committed, so another session could
+        block on, or miss, the thread's uncommitted writes; the query then
+        runs on the thread's connection instead.
+        """
+        if self.is_test:
+            return self.query(sql, params).fetchall()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(*parameterized(sql, params))
+            return cur.fetchall()
+
+    def iter_rows(self, cursor, batch_size=None):
+        """Yield the rows of an executed cursor, fetched in batches"""
+        batch_size = batch_size or self.fetch_size
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_query(self, sql, params=None, batch_size=None):
+        """
+        Yield the rows of sql, fetched in batches on a connection of its own
+        so other queries can run while the generator is being consumed.
+        In test environments the rows are read in full on the thread's
+        connection, as for fetch_all.
+        """
+        if self.is_test:
+            yield from self.fetch_all(sql, params)
+            return
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(*parameterized(sql, params))
+            yield from self.iter_rows(cur, batch_size)
+
+    def execute(self, sql, commit=None, params=None):
+        if commit is None:
+            commit = not self.is_test
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(*parameterized(sql, params))
+            if commit:
+                conn.commit()
+        except Exception as e:
+            log.error(f'Error executing {sql} {params or ""}: {e}')
+
+    def call(self, procedure, params=(), commit=None):
+        """
+        Execute a stored procedure as a remote procedure call, with values
+        passed as parameters rather than compiled into an ad-hoc batch
+        """
         if commit is None:
             commit = not self.is_test
         conn = self.get_connection()
         cur = conn.cursor()
         try:
-            cur.execute(sql)
+            cur.callproc(procedure, tuple(params))
             if commit:
                 conn.commit()
         except Exception as e:
-            log.error(f'Error executing {sql}: {e}')
+            log.error(f'Error calling {procedure} {params}: {e}')
 
     def check_exists(self, sql):
         sql_wrapper = f"if exists ({sql}) select 1 else select 0"
@@ -209,9 +829,17 @@ class Environment:
         for row in cur:
             return row[0]
 
-    def send_email(
-        self, send_to, send_body, send_subject, alt_body, force_send=False
-    ):
+    def new_smtp_session(self):
+        """A new, authenticated SMTP session, not shared with send_email"""
+        server = smtplib.SMTP_SSL(self.email_host, 465, timeout=120)
+        server.ehlo()
+        server.login(self.email_user, self.email_pwd)
+        return server
+
+    def build_email(self, send_to, send_body, send_subject, alt_body):
+        """
+        :return: (recipients, message text) ready for sendmail
+        """
         msg = MIMEMultipart('alternative')
 
         if self.env_type != "prod":
@@ -223,7 +851,7 @@ class Environment:
         msg['To'] = send_to
         msg['Date'] = formatdate(localtime=True)
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        msg['Message-Id'] = f'{timestamp}@crowbank.co.uk'
+        msg['Message-Id'] = f'<{timestamp}.{uuid4().hex}@crowbank.co.uk>'
 
         part1 = MIMEText(alt_body, 'plain')
         part2 = MIMEText(send_body, 'html')
@@ -231,35 +859,132 @@ class Environment:
         msg.attach(part1)
         msg.attach(part2)
 
-        try:
-            server = self.get_smtp_server()
-            server.sendmail(self.email_user, [send_to], msg.as_string())
-        except smtplib.SMTPServerDisconnected:
-            self.smtp_server.connect()
-            server.sendmail(self.email_user, [send_to], msg.as_string())
-
-    def send_email_old(
-            self, send_to, send_body, send_subject, force_send=False):
-        target = [send_to]
-        if ENVIRONMENT != "prod":
-            send_subject += f' ({ENVIRONMENT})'
-            target = [self.email_bcc]
-        msg = f"""
-To:{send_to}\nMIME-Version: 1.0\nContent-type: text/html\n
-From: Crowbank Kennels and Cattery <{self.email_user}>\n
-Subject:{send_subject}\n
-\n
-{send_body}"""
+        return [send_to], msg.as_string()
 
-        try:
-            server = self.get_smtp_server()
-            server.sendmail(self.email_user, target, msg)
-        except smtplib.SMTPServerDisconnected:
-            self.smtp_server.connect()
-            self.smtp_server.sendmail(self.email_user, target, msg)
+    def send_email(
+        self, send_to, send_body, send_subject, alt_body, force_send=False,
+        after=None
+    ):
+        """
+        :param after: optional (procedure, params) stored procedure call
+                      recording the email, made once it has been delivered
+        :return: the name of the spooled message when using an outbox
+        """
+        recipients, text = self.build_email(
+            send_to, send_body, send_subject, alt_body)
+
+        if self.outbox:
+            return self.outbox.put(recipients, text, after)
+
+        with self.smtp_lock:
+            for attempt in range(SMTP_RETRIES + 1):
+                server = self.get_smtp_server()
+                try:
+                    server.sendmail(self.email_user, recipients, text)
+                    break
+                except smtplib.SMTPRecipientsRefused:
+                    raise
+                except Exception:
+                    if not _smtp_alive(server):
+                        self.smtp_server = None
+                    if attempt == SMTP_RETRIES:
+                        raise
+
+        if after:
+            try:
+                self.writer.call(*after)
+            except Exception as e:
+                log.exception(f'Unable to record email to {recipients}: {e}')
+
+    def use_outbox(self, folder, interval=OUTBOX_INTERVAL):
+        """
+        From now on, have send_email spool messages to folder and return,
+        leaving delivery to a background dispatcher
+        """
+        from .outbox import Outbox
+
+        self.outbox = Outbox(self, folder, interval)
+        self.outbox.start()
+
+    def send_bulk(self, messages, workers=SMTP_WORKERS, retries=SMTP_RETRIES):
+        """
+        Send many emails over a few SMTP sessions, each kept open for all
+        the messages its worker sends.
+        :param messages: (send_to, send_body, send_subject, alt_body) tuples
+        :return: the messages that could not be sent
+        """
+        messages = list(messages)
+        sent = self.deliver(
+            (self.build_email(*message) for message in messages),
+            workers, retries)
+        return [message for message, ok in zip(messages, sent) if not ok]
+
+    def deliver(self, emails, workers=SMTP_WORKERS, retries=SMTP_RETRIES):
+        """
+        Send built emails over a few SMTP sessions, each kept open for all
+        the messages its worker sends. A session is only checked when a
+        send fails, and replaced if it has dropped.
+        :param emails: (recipients, message text) pairs, as from build_email
+        :return: a list of flags, True for each email that was sent
+        """
+        emails = list(emails)
+        local = threading.local()
+        sessions = []
+        sessions_lock = threading.Lock()
+
+        def send(email):
+            recipients, text = email
+            error = None
+            for _ in range(retries + 1):
+                session = getattr(local, 'session', None)
+                try:
+                    if session is None:
+                        session = self.new_smtp_session()
+                        local.session = session
+                        with sessions_lock:
+                            sessions.append(session)
+                    session.sendmail(self.email_user, recipients, text)
+                    return True
+                except smtplib.SMTPRecipientsRefused as e:
+                    error = e
+                    break
+                except Exception as e:
+                    error = e
+                    if session is not None and not _smtp_alive(session):
+                        local.session = None
+            log.error(f'Unable to send email to {recipients}: {error}')
+            return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sent = list(executor.map(send, emails))
+        elapsed = time.perf_counter() - start
+
+        for session in sessions:
+            try:
+                session.quit()
+            except Exception:
+                pass
+
+        count = sum(sent)
+        # debug only: at info the log digest would mail this, and the
+        # digest's own delivery would log it again
+        log.debug(
+            f'Sent {count} of {len(emails)} emails in {elapsed:.1f}s '
+            f'({count / elapsed if elapsed else 0:.1f}/s)')
+        return sent
 
     def close(self):
-        if self.connection:
-            self.connection.close()
-        if self.smtp_handler:
-            self.smtp_handler.flush()
+        try:
+            if self.outbox:
+                self.outbox.close()
+        finally:
+            try:
+                self.writer.close()
+                if self.db_handler:
+                    self.db_handler.close()
+            finally:
+                self.release_connection()
+                self.pool.close()
+                if self.smtp_handler:
+                    self.smtp_handler.close()
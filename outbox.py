@@ -0,0 +1,260 @@
+import json
+import os
+import threading
+import time
+from decimal import Decimal
+from .env import log, OUTBOX_INTERVAL, SMTP_WORKERS
+
+OUTBOX_ATTEMPTS = 10
+# messages spooled before the dispatcher is woken early; fewer wait for the
+# next interval, so each dispatch sends a batch over a few sessions
+OUTBOX_BATCH = 50
+# seconds after which a claimed message is assumed abandoned by a process
+# that died while sending it, and put back in the spool
+OUTBOX_CLAIM_TIMEOUT = 3600
+
+
+def _encode(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'Cannot spool {value!r}')
+
+
+class Outbox:
+    """
+    A spool directory of built emails awaiting delivery. Each message is
+    kept as <name>.eml, with <name>.json holding its recipients, the number
+    of delivery attempts so far, when to next try it and an optional stored
+    procedure call to make once it has been delivered. The .json file is
+    written last, so a message is only picked up once completely spooled.
+    A failed message is retried after interval seconds, and moved to the
+    failed subfolder after OUTBOX_ATTEMPTS attempts.
+    Before sending, a dispatcher claims a message by renaming its .json file
+    to .sending, so processes sharing the folder never send it twice.
+    The background dispatcher runs every interval seconds, or as soon as
+    batch messages have been spooled. Delivery records are made on the
+    dispatching thread, except that in test environments, where nothing is
+    committed, the background thread leaves them for the next dispatch() or
+    close() on the caller's thread.
+    """
+
+    def __init__(self, env, folder, interval=OUTBOX_INTERVAL,
+                 workers=SMTP_WORKERS, batch=OUTBOX_BATCH):
+        self.env = env
+        self.folder = folder
+        self.interval = interval
+        self.batch = batch
+        self.failed_folder = os.path.join(folder, 'failed')
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.count = 0
+        # spooled since the last dispatch
+        self.spooled = 0
+        # (name, (procedure, params)) of delivered messages not yet recorded
+        self.records = []
+        # one dispatch at a time within the process; names delivered by it
+        self.dispatch_lock = threading.Lock()
+        self.delivered = set()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+        os.makedirs(self.failed_folder, exist_ok=True)
+
+    def put(self, recipients, text, after=None):
+        """
+        Spool a message for delivery.
+        :param after: optional (procedure, params) call made once delivered
+        :return: the name of the spooled message
+        """
+        with self.lock:
+            self.count += 1
+            self.spooled += 1
+            name = f'{time.time_ns()}-{os.getpid()}-{self.count}'
+            wake = self.spooled >= self.batch
+
+        meta = {
+            'recipients': recipients, 'attempts': 0, 'retry_at': 0,
+            'after': after}
+        self._write(f'{name}.eml', text)
+        self._write(f'{name}.json', json.dumps(meta, default=_encode))
+        if wake:
+            self.wakeup.set()
+        return name
+
+    def pending(self):
+        """Names of the spooled messages, oldest first"""
+        return sorted(
+            entry[:-5] for entry in os.listdir(self.folder)
+            if entry.endswith('.json'))
+
+    def was_delivered(self, name):
+        """Whether a message spooled as name was delivered by this process"""
+        with self.lock:
+            return name in self.delivered
+
+    def dispatch(self):
+        """
+        Try to deliver every spooled message that is due, in parallel, and
+        record every delivery so far on the calling thread.
+        Waits for any dispatch already under way in this process.
+        :return: number of messages delivered
+        """
+        with self.dispatch_lock:
+            delivered = self._dispatch()
+        self._record()
+        return delivered
+
+    def _dispatch(self):
+        with self.lock:
+            self.spooled = 0
+        now = time.time()
+        messages = []
+        for name in self.pending():
+            try:
+                meta = json.loads(self._read(f'{name}.json'))
+            except FileNotFoundError:
+                continue  # claimed by another process since listed
+            except Exception as e:
+                log.error(f'Unable to read spooled email {name}: {e}')
+                self._move(name, self.failed_folder)
+                continue
+            if meta['retry_at'] > now or not self._claim(name):
+                continue
+            try:
+                # re-read, as it may have been retried meanwhile
+                meta = json.loads(self._read(f'{name}.sending'))
+                text = self._read(f'{name}.eml')
+            except Exception as e:
+                log.error(f'Unable to read spooled email {name}: {e}')
+                self._move(name, self.failed_folder)
+                continue
+            messages.append((name, meta, text))
+
+        if not messages:
+            return 0
+
+        sent = self.env.deliver(
+            ((meta['recipients'], text) for _, meta, text in messages),
+            self.workers)
+
+        delivered = 0
+        for (name, meta, _), ok in zip(messages, sent):
+            if ok:
+                self._remove(name)
+                with self.lock:
+                    self.delivered.add(name)
+                    if meta['after']:
+                        self.records.append((name, meta['after']))
+                delivered += 1
+                continue
+
+            meta['attempts'] += 1
+            meta['retry_at'] = now + self.interval
+            if meta['attempts'] >= OUTBOX_ATTEMPTS:
+                log.error(
+                    f'Giving up on email {name} to {meta["recipients"]} '
+                    f'after {meta["attempts"]} attempts')
+                self._move(name, self.failed_folder)
+            else:
+                # update the claimed copy, then hand it back to the spool
+                self._write(
+                    f'{name}.sending', json.dumps(meta, default=_encode))
+                os.replace(
+                    self._path(f'{name}.sending'), self._path(f'{name}.json'))
+
+        return delivered
+
+    def start(self):
+        """
+        Dispatch from a background thread whenever a message is spooled,
+        and every interval seconds to retry failed deliveries
+        """
+        self.recover()
+        self.thread = threading.Thread(
+            target=self._run, name='Outbox', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stop the dispatcher after a last attempt to empty the spool"""
+        if self.thread is not None:
+            self.stopping = True
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        self.dispatch()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            try:
+                with self.dispatch_lock:
+                    self._dispatch()
+                if not self.env.is_test:
+                    self._record()
+            except Exception as e:
+                log.exception(f'Error dispatching outbox: {e}')
+
+    def _record(self):
+        """Make the stored procedure calls of delivered messages"""
+        with self.lock:
+            records, self.records = self.records, []
+        for name, (procedure, params) in records:
+            try:
+                self.env.writer.call(procedure, params)
+            except Exception as e:
+                log.exception(f'Unable to record delivery of {name}: {e}')
+
+    def recover(self):
+        """Put back in the spool messages claimed too long ago"""
+        now = time.time()
+        for entry in os.listdir(self.folder):
+            if not entry.endswith('.sending'):
+                continue
+            path = self._path(entry)
+            try:
+                if now - os.path.getmtime(path) > OUTBOX_CLAIM_TIMEOUT:
+                    os.rename(path, self._path(f'{entry[:-8]}.json'))
+                    log.warning(f'Recovered abandoned email {entry[:-8]}')
+            except OSError:
+                pass  # sent, or recovered by another process
+
+    def _claim(self, name):
+        """
+        Take a message for sending. The rename only succeeds for one
+        process, however many share the folder.
+        :return: True if claimed here
+        """
+        claim = self._path(f'{name}.sending')
+        try:
+            os.rename(self._path(f'{name}.json'), claim)
+        except OSError:
+            return False
+        os.utime(claim)
+        return True
+
+    def _path(self, file_name):
+        return os.path.join(self.folder, file_name)
+
+    def _read(self, file_name):
+        with open(self._path(file_name), encoding='utf-8') as f:
+            return f.read()
+
+    def _write(self, file_name, content):
+        path = self._path(file_name)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(f'{path}.tmp', path)
+
+    def _remove(self, name):
+        os.remove(self._path(f'{name}.sending'))
+        os.remove(self._path(f'{name}.eml'))
+
+    def _move(self, name, folder):
+        for extension, target in (
+                ('.json', '.json'), ('.sending', '.json'), ('.eml', '.eml')):
+            path = self._path(f'{name}{extension}')
+            if os.path.exists(path):
+                os.replace(path, os.path.join(folder, f'{name}{target}'))
@@ -1,6 +1,10 @@
-from .env import log
+from .env import log, in_lists, intern_str
 from datetime import date
 
+SQL_PET = """
+select pet_no, cust_no, pet_name, breed_no, spec_desc, pet_dob, pet_sex,
+pet_vacc_status from vwpet"""
+
 class Pets:
     """Representing a collection of Pets"""
 
@@ -10,28 +14,60 @@ class Pets:
         self.loaded = False
         self.customers = customers
         self.breeds = breeds
+        # when lazy, get() fetches a missing pet on demand
+        self.lazy = False
+        self.missing = set()
 
     def get(self, pet_no):
         if pet_no in self.pets:
             return self.pets[pet_no]
-        else:
-            return None
 
-    def load_by_sql(self, sql):
-        cursor = self.env.get_cursor()
+        if self.lazy and not self.loaded and pet_no not in self.missing:
+            self.load_one(pet_no)
+            if pet_no in self.pets:
+                return self.pets[pet_no]
+            self.missing.add(pet_no)
+
+        return None
+
+    def load_one(self, pet_no):
+        if self.loaded or pet_no in self.pets:
+            return
+
+        log.debug(f'Loading pet #{pet_no}')
+        if self.breeds is not None:
+            self.breeds.load()
+
+        # lazy loads can happen while another query's rows are streaming,
+        # so use a connection of their own
+        self.load_rows(
+            self.env.fetch_all(f"{SQL_PET} where pet_no = %s", (pet_no,)))
 
-        cursor.execute(sql)
-        for row in cursor:
+    def load_by_sql(self, sql, params=None):
+        # streamed on a connection of its own, so that queries made while
+        # the rows are processed do not cut the stream short
+        self.load_rows(self.env.iter_query(sql, params))
+
+    def load_rows(self, rows):
+        for row in rows:
             pet_no = row[0]
-            pet = Pet(pet_no)
+            pet = self.pets.get(pet_no)
+            if pet is None:
+                pet = Pet(pet_no)
             cust_no = row[1]
             if self.customers is not None:
                 customer = self.customers.get(cust_no)
                 if not customer:
                     log.error(f'Missing customer for pet #{pet_no}')
                     next()
+                # a reloaded pet may have moved to another customer
+                previous = pet.customer
+                if previous is not None and previous is not customer and \
+                        pet in previous.pets:
+                    previous.pets.remove(pet)
                 pet.customer = customer
-                customer.add_pet(pet)
+                if pet not in customer.pets:
+                    customer.add_pet(pet)
             pet.name = row[2]
             breed_no = row[3]
             if self.breeds is not None:
@@ -40,10 +76,10 @@ class Pets:
                     log.error(f'Missing breed for pet #{pet_no}')
                     next()
             pet.breed = breed
-            pet.spec = row[4]
+            pet.spec = intern_str(row[4])
             pet.dob = row[5]
-            pet.sex = row[6]
-            pet.vacc_status = row[7]
+            pet.sex = intern_str(row[6])
+            pet.vacc_status = intern_str(row[7])
             self.pets[pet_no] = pet
 
     def load_for_customer(self, cust_no):
@@ -57,14 +93,23 @@ class Pets:
         if self.breeds is not None:
             self.breeds.load()
 
-        sql = f"""
-select pet_no, cust_no, pet_name, breed_no, spec_desc, pet_dob, pet_sex,
-pet_vacc_status from vwpet where cust_no = {cust_no}"""
-        self.load_by_sql(sql)
+        sql = f"{SQL_PET} where cust_no = %s"
+        self.load_rows(self.env.fetch_all(sql, (cust_no,)))
 
         log.debug('Loaded %d pets', len(self.pets))
-        self.loaded = True
-        
+
+
+    def reload_for_customers(self, cust_nos):
+        """
+        (Re)load the pets of the given customers, updating existing objects
+        in place
+        """
+        if self.breeds is not None:
+            self.breeds.load()
+
+        for keys in in_lists(cust_nos):
+            self.load_rows(self.env.fetch_all(
+                f"{SQL_PET} where cust_no in ({keys})"))
 
     def load(self, force=False):
         if self.loaded and not force:
@@ -76,9 +121,7 @@ pet_vacc_status from vwpet where cust_no = {cust_no}"""
         if self.breeds is not None:
             self.breeds.load()
 
-        sql = """select pet_no, cust_no, pet_name, breed_no, spec_desc, pet_dob,
-pet_sex, pet_vacc_status from vwpet"""
-        self.load_by_sql(sql)
+        self.load_by_sql(SQL_PET)
 
         log.debug(f'Loaded {len(self.pets)} pets')
         self.loaded = True
@@ -87,6 +130,9 @@ pet_sex, pet_vacc_status from vwpet"""
 class Pet:
     """Reoresenting a PetAdmin Pet"""
 
+    __slots__ = (
+        'no', 'name', 'customer', 'breed', 'sex', 'spec', 'dob', 'vacc_status')
+
     def __init__(self, pet_no):
         self.no = pet_no
         self.name = ''
@@ -95,6 +141,7 @@ class Pet:
         self.sex = ''
         self.spec = ''
         self.dob = date.today()
+        self.vacc_status = ''
 
     def __str__(self):
         return self.name
@@ -1,13 +1,67 @@
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 from .env import log
-from .customer import Customers
-from .breed import Breeds
-from .pet import Pets
-from .service import Services
-from .booking import Bookings
-from .run import Runs
+from .customer import Customers, SQL_CUSTOMER
+from .breed import Breeds, SQL_BREED
+from .pet import Pets, SQL_PET
+from .service import Services, SQL_SERVICE
+from .booking import Bookings, SQL_BOOKING, SQL_BOOKINGITEM, SQL_INVITEM, \
+    SQL_INVEXTRA, SQL_PAYMENT
+from .run import Runs, SQL_RUN, SQL_RUNOCCUPANCY
+
+SNAPSHOT_VERSION = 7
+SNAPSHOT_COLLECTIONS = (
+    'customers', 'breeds', 'pets', 'services', 'bookings', 'runs')
+# row count of every loaded query and the latest audit date. Customers and
+# pets are small and their edits (an address change, say) are neither
+# counted nor audited, so they are checksummed as well.
+CHECKSUMMED = (SQL_CUSTOMER, SQL_PET)
+SQL_FRESHNESS = 'select * from ' + '\ncross join '.join(
+    f'(select count(*) c{i}'
+    + (f', checksum_agg(binary_checksum(*)) s{i}' if sql in CHECKSUMMED
+       else '')
+    + f' from ({sql}) q{i}) t{i}'
+    for i, sql in enumerate((
+        SQL_CUSTOMER, SQL_BREED, SQL_PET, SQL_SERVICE, SQL_BOOKING,
+        SQL_BOOKINGITEM, SQL_INVITEM, SQL_INVEXTRA, SQL_PAYMENT, SQL_RUN,
+        SQL_RUNOCCUPANCY))
+    ) + '\ncross join (select max(aud_date) aud_date from vwaudit) a'
+SQL_AUDIT_MARK = "select max(aud_date) from vwaudit"
+
+
+class _SnapshotPickler(pickle.Pickler):
+    """Pickles the object graph, leaving the environment out"""
+
+    def __init__(self, file, env):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.env = env
+
+    def persistent_id(self, obj):
+        if obj is self.env:
+            return 'env'
+        return None
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, env):
+        super().__init__(file)
+        self.env = env
+
+    def persistent_load(self, pid):
+        if pid == 'env':
+            return self.env
+        raise pickle.UnpicklingError(f'Unknown persistent id {pid}')
+
 
 class PetAdmin:
-    def __init__(self, env):
+    def __init__(self, env, lazy=False):
+        """
+        :param lazy: if True, bookings, customers and pets missing from a
+            collection that has not been fully loaded are fetched on demand
+            by get(), so tools dealing with a single booking need not load()
+        """
         self.env = env
         self.customers = Customers(env)
         self.breeds = Breeds(env)
@@ -16,21 +70,219 @@ class PetAdmin:
         self.bookings = Bookings(env, self.customers, self.pets, self.services)
         self.runs = Runs(env, self.bookings, self.pets)
         self.loaded = False
+        self.lazy = lazy
+        self.customers.lazy = lazy
+        self.pets.lazy = lazy
+        self.bookings.lazy = lazy
+        self.audit_mark = None
 
-    def load(self, force=False):
+    def load(self, force=False, concurrent=False, workers=4, snapshot=None):
+        """Load all collections.
+
+        :param force: reload even if already loaded
+        :param concurrent: fetch the underlying views in parallel, each on
+            a connection of its own, and link the object graph once all rows
+            have arrived. Ignored in test environments.
+        :param workers: maximum number of parallel connections when
+            concurrent
+        :param snapshot: path of a snapshot file. If it is still fresh it is
+            restored instead of loading from the database; otherwise the
+            database is loaded and the snapshot rewritten
+        """
         if self.loaded and not force:
             return
 
         log.debug('Loading PetAdmin')
-        self.customers.load(force)
-        self.pets.load(force)
-        self.services.load(force)
-        self.bookings.load(force)
-        self.runs.load(force)
+        start = time.perf_counter()
+        freshness = None
+        if snapshot:
+            freshness = self.freshness()
+            self.audit_mark = freshness[-1]
+            if not force and self.load_snapshot(snapshot, freshness):
+                self.loaded = True
+                log.debug(
+                    f'Loading PetAdmin Complete ({time.perf_counter() - start:.2f}s, '
+                    f'snapshot)')
+                return
+        else:
+            self.audit_mark = self.get_audit_mark()
+
+        # in test environments reads stay on this thread's connection
+        if concurrent and not self.env.is_test:
+            self.load_concurrent(workers)
+        else:
+            self.customers.load(force)
+            self.pets.load(force)
+            self.services.load(force)
+            self.bookings.load(force)
+            self.runs.load(force)
+
+        self.loaded = True
+        log.debug(
+            f'Loading PetAdmin Complete ({time.perf_counter() - start:.2f}s, '
+            f'{"concurrent" if concurrent else "serial"})')
+
+        if snapshot:
+            self.save_snapshot(snapshot, freshness)
+
+    def get_audit_mark(self):
+        cursor = self.env.get_cursor()
+        cursor.execute(SQL_AUDIT_MARK)
+        return cursor.fetchone()[0]
+
+    def refresh(self):
+        """
+        Bring a loaded PetAdmin up to date by reloading only the bookings
+        audited since the last load or refresh, together with their
+        customers, pets and run occupancy.
+        Changes to customers or pets with no booking activity are not seen.
+        """
+        if not self.loaded:
+            self.load()
+            return
+
+        new_mark = self.get_audit_mark()
+        if new_mark is None or new_mark == self.audit_mark:
+            return
+
+        # with no mark, nothing had been audited when the data was loaded
+        if self.audit_mark is None:
+            sql = "select distinct bk_no from vwaudit where aud_date <= %s"
+            params = (new_mark,)
+        else:
+            sql = """
+select distinct bk_no from vwaudit
+where aud_date > %s
+and aud_date <= %s"""
+            params = (self.audit_mark, new_mark)
+        cursor = self.env.query(sql, params)
+        bk_nos = set(row[0] for row in cursor.fetchall())
+
+        log.debug(f'Refreshing {len(bk_nos)} bookings')
+        self.bookings.reload(bk_nos)
+        if self.runs.loaded:
+            self.runs.reload_occupancy(bk_nos)
+
+        self.audit_mark = new_mark
+
+    def freshness(self):
+        """
+        A cheap fingerprint of the database content, used to decide whether
+        a snapshot can still be used
+        """
+        cursor = self.env.get_cursor()
+        cursor.execute(SQL_FRESHNESS)
+        return tuple(cursor.fetchone())
+
+    def save_snapshot(self, file_name, freshness=None):
+        """
+        Save the loaded object graph to file_name.
+        freshness should be taken before the data was loaded, so that changes
+        made while loading invalidate the snapshot rather than being missed.
+        """
+        if freshness is None:
+            freshness = self.freshness()
+
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'freshness': freshness,
+        }
+        for name in SNAPSHOT_COLLECTIONS:
+            state[name] = getattr(self, name)
+
+        tmp_name = file_name + '.tmp'
+        try:
+            with open(tmp_name, 'wb') as f:
+                _SnapshotPickler(f, self.env).dump(state)
+            os.replace(tmp_name, file_name)
+        except Exception as e:
+            log.error(f'Unable to save snapshot {file_name}: {e}')
+            return
+
+        log.debug(f'Saved snapshot {file_name}')
+
+    def load_snapshot(self, file_name, freshness=None):
+        """
+        Restore the object graph from file_name.
+        :return: True if restored, False if the snapshot is missing, stale
+            or unreadable
+        """
+        if not os.path.exists(file_name):
+            return False
+
+        try:
+            with open(file_name, 'rb') as f:
+                state = _SnapshotUnpickler(f, self.env).load()
+        except Exception as e:
+            log.error(f'Unable to read snapshot {file_name}: {e}')
+            return False
+
+        if state.get('version') != SNAPSHOT_VERSION:
+            log.debug(f'Snapshot {file_name} has an old version')
+            return False
+
+        if freshness is None:
+            freshness = self.freshness()
+        if state['freshness'] != freshness:
+            log.debug(f'Snapshot {file_name} is stale')
+            return False
+
+        for name in SNAPSHOT_COLLECTIONS:
+            setattr(self, name, state[name])
 
         self.loaded = True
-        log.debug('Loading PetAdmin Complete')
+        log.debug(f'Restored snapshot {file_name}')
+        return True
+
+    def load_concurrent(self, workers=4):
+        queries = {
+            'customers': SQL_CUSTOMER,
+            'breeds': SQL_BREED,
+            'pets': SQL_PET,
+            'services': SQL_SERVICE,
+            'bookings': SQL_BOOKING,
+            'bookingitems': SQL_BOOKINGITEM,
+            'invitems': SQL_INVITEM,
+            'invextras': SQL_INVEXTRA,
+            'payments': SQL_PAYMENT,
+            'runs': SQL_RUN,
+            'occupancy': SQL_RUNOCCUPANCY,
+        }
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                name: executor.submit(self.env.fetch_all, sql)
+                for name, sql in queries.items()}
+            rows = {name: future.result() for name, future in futures.items()}
+
+        # Linking order matters: each collection resolves references into
+        # the ones loaded before it.
+        self.customers.load_rows(rows['customers'])
+        self.customers.loaded = True
+        self.breeds.load_rows(rows['breeds'])
+        self.breeds.loaded = True
+        self.pets.load_rows(rows['pets'])
+        self.pets.loaded = True
+        self.services.load_rows(rows['services'])
+        self.services.loaded = True
+        self.bookings.load_booking_rows(rows['bookings'])
+        self.bookings.load_bookingitem_rows(rows['bookingitems'])
+        self.bookings.load_invitem_rows(rows['invitems'])
+        self.bookings.load_invextra_rows(rows['invextras'])
+        self.bookings.load_payment_rows(rows['payments'])
+        self.bookings.loaded = True
+        self.runs.load_run_rows(rows['runs'])
+        self.runs.load_occupancy_rows(rows['occupancy'])
+        self.runs.compute_vacancies()
+        self.runs.loaded = True
     
+    def load_bookings(self, bk_nos):
+        """Load just the given bookings and their dependents"""
+        if self.loaded:
+            return
+
+        self.bookings.load_many(bk_nos)
+
     def load_customer(self, cust_no):
         if self.loaded:
             return
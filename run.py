@@ -1,5 +1,209 @@
-from .env import log
-from datetime import date, timedelta
+from .env import log, in_lists, intern_str
+from bisect import bisect_left, bisect_right
+from datetime import date
+from operator import attrgetter
+from types import MappingProxyType
+
+SQL_RUN = "select run_no, run_code, spec_desc, rt_desc from vwrun"
+SQL_RUNOCCUPANCY = """
+select ro_run_no, ro_pet_no, ro_date, ro_bk_no, ro_type from vwrunoccupancy"""
+
+UNBOUNDED = 1 << 60
+# days added beyond the requested range whenever the calendar has to grow
+CALENDAR_MARGIN = 90
+
+
+def _as_date(value):
+    if hasattr(value, 'date'):
+        return value.date()
+    return value
+
+
+class MinTree:
+    """
+    Segment tree over a list of integers, answering range minimum queries
+    and applying range additions in O(log n)
+    """
+
+    def __init__(self, values):
+        self.n = len(values)
+        self.size = 1
+        while self.size < max(self.n, 1):
+            self.size *= 2
+        self.low = [UNBOUNDED] * (2 * self.size)
+        self.pending = [0] * (2 * self.size)
+        self.low[self.size:self.size + self.n] = values
+        for i in range(self.size - 1, 0, -1):
+            self.low[i] = min(self.low[2 * i], self.low[2 * i + 1])
+
+    def minimum(self, first, last):
+        """Minimum of values[first..last], inclusive"""
+        return self._minimum(1, 0, self.size - 1, first, last)
+
+    def _minimum(self, node, lo, hi, first, last):
+        if last < lo or hi < first:
+            return UNBOUNDED
+        if first <= lo and hi <= last:
+            return self.low[node]
+        mid = (lo + hi) // 2
+        return self.pending[node] + min(
+            self._minimum(2 * node, lo, mid, first, last),
+            self._minimum(2 * node + 1, mid + 1, hi, first, last))
+
+    def add(self, first, last, delta):
+        """Add delta to values[first..last], inclusive"""
+        self._add(1, 0, self.size - 1, first, last, delta)
+
+    def _add(self, node, lo, hi, first, last, delta):
+        if last < lo or hi < first:
+            return
+        if first <= lo and hi <= last:
+            self.low[node] += delta
+            self.pending[node] += delta
+            return
+        mid = (lo + hi) // 2
+        self._add(2 * node, lo, mid, first, last, delta)
+        self._add(2 * node + 1, mid + 1, hi, first, last, delta)
+        self.low[node] = self.pending[node] + \
+            min(self.low[2 * node], self.low[2 * node + 1])
+
+
+class VacancyCalendar:
+    """
+    Number of vacant runs per day and (spec, run type), held as one dense
+    row of counts per run type starting at first_date. Days outside the
+    calendar are assumed to have every run vacant.
+    """
+
+    def __init__(self, first_date, days, capacity):
+        self.first_ordinal = first_date.toordinal()
+        self.days = max(days, 0)
+        self.capacity = dict(capacity)
+        self.counts = {
+            key: [count] * self.days for key, count in self.capacity.items()}
+        self.trees = {}
+
+    @classmethod
+    def from_runs(cls, runs_by_type, first_date, last_date):
+        capacity = {
+            (spec, run_type): len(runs)
+            for spec, types in runs_by_type.items()
+            for run_type, runs in types.items()}
+        calendar = cls(
+            first_date, (last_date - first_date).days + 1, capacity)
+
+        # difference arrays: -1 where a run's occupied stretch starts and
+        # +1 the day after it ends, then a single running sum per run type
+        for (spec, run_type) in capacity:
+            diff = [0] * (calendar.days + 1)
+            for run in runs_by_type[spec][run_type]:
+                for first, last in run.occupied_ranges():
+                    diff[first - calendar.first_ordinal] -= 1
+                    diff[last - calendar.first_ordinal + 1] += 1
+            row = calendar.counts[(spec, run_type)]
+            vacant = capacity[(spec, run_type)]
+            for i in range(calendar.days):
+                vacant += diff[i]
+                row[i] = vacant
+
+        for key, row in calendar.counts.items():
+            calendar.trees[key] = MinTree(row)
+
+        return calendar
+
+    def add(self, spec, run_type, first, last, delta):
+        """
+        Add delta to the vacancies of a run type from ordinal first to last,
+        growing the calendar if needed
+        """
+        key = (spec, run_type)
+        if key not in self.capacity:
+            return
+        self._extend(first, last)
+        lo = first - self.first_ordinal
+        hi = last - self.first_ordinal
+        row = self.counts[key]
+        for i in range(lo, hi + 1):
+            row[i] += delta
+        self.trees[key].add(lo, hi, delta)
+
+    def _extend(self, first, last):
+        end = self.first_ordinal + self.days - 1
+        if self.days and self.first_ordinal <= first and last <= end:
+            return
+
+        if self.days:
+            new_first = min(first - CALENDAR_MARGIN, self.first_ordinal) \
+                if first < self.first_ordinal else self.first_ordinal
+            new_last = max(last + CALENDAR_MARGIN, end) if last > end else end
+            before = self.first_ordinal - new_first
+        else:
+            new_first, new_last = first, last
+            before = 0
+        days = new_last - new_first + 1
+
+        for key, row in self.counts.items():
+            vacant = self.capacity[key]
+            row = [vacant] * before + row
+            row += [vacant] * (days - len(row))
+            self.counts[key] = row
+            self.trees[key] = MinTree(row)
+
+        self.first_ordinal = new_first
+        self.days = days
+
+    def vacancy(self, ro_date, spec, run_type):
+        key = (spec, run_type)
+        if key not in self.capacity:
+            return 0
+        offset = _as_date(ro_date).toordinal() - self.first_ordinal
+        if 0 <= offset < self.days:
+            return self.counts[key][offset]
+        return self.capacity[key]
+
+    def feasible_starts(self, spec, run_type, days, run_count, first, last):
+        """
+        Ordinals from first to last on which a stay of days days can start
+        with at least run_count runs vacant throughout, in order.
+        A prefix count of short days over the searched range answers each
+        candidate start in constant time.
+        """
+        key = (spec, run_type)
+        if key not in self.capacity or self.capacity[key] < run_count or \
+                days < 1 or last < first:
+            return []
+
+        row = self.counts[key]
+        short = [0]
+        for ordinal in range(first, last + days):
+            offset = ordinal - self.first_ordinal
+            vacant = row[offset] if 0 <= offset < self.days \
+                else self.capacity[key]
+            short.append(short[-1] + (vacant < run_count))
+
+        return [
+            first + i for i in range(last - first + 1)
+            if short[i + days] == short[i]]
+
+    def min_vacancy(self, from_date, to_date, spec, run_type):
+        """Smallest number of vacant runs on any day from from_date to to_date"""
+        key = (spec, run_type)
+        if key not in self.capacity:
+            return 0
+        first = _as_date(from_date).toordinal() - self.first_ordinal
+        last = _as_date(to_date).toordinal() - self.first_ordinal
+        if last < first:
+            return self.capacity[key]
+
+        result = UNBOUNDED
+        if first < 0 or last >= self.days:
+            result = self.capacity[key]
+        first = max(first, 0)
+        last = min(last, self.days - 1)
+        if first <= last:
+            result = min(result, self.trees[key].minimum(first, last))
+        return result
+
 
 class Runs:
     """
@@ -13,7 +217,7 @@ class Runs:
         self.bookings = bookings
         self.pets = pets
         self.potential_vacancies = {}
-        self.vacancies = {}
+        self.calendar = None
         self.min_date = date(2099, 12, 31)
         self.max_date = date(1970, 1, 1)
         self.loaded = False
@@ -22,16 +226,22 @@ class Runs:
         if self.loaded and not force:
             return
 
-        sql = "select run_no, run_code, spec_desc, rt_desc from vwrun"
-        cursor = self.env.get_cursor()
-        cursor.execute(sql)
+        self.load_run_rows(self.env.iter_query(SQL_RUN))
+        rows = list(self.env.iter_query(SQL_RUNOCCUPANCY))
+        # fetch any bookings not yet loaded in one go, rather than one by one
+        self.bookings.load_many(set(row[3] for row in rows))
+        self.load_occupancy_rows(rows)
 
-        for row in cursor:
+        self.compute_vacancies()
+        self.loaded = True
+
+    def load_run_rows(self, rows):
+        for row in rows:
             run = Run()
             run.no = row[0]
             run.code = row[1]
-            run.spec = row[2]
-            run.type = row[3]
+            run.spec = intern_str(row[2])
+            run.type = intern_str(row[3])
             self.runs[run.no] = run
             if run.spec not in self.runs_by_type:
                 self.runs_by_type[run.spec] = {}
@@ -44,36 +254,83 @@ class Runs:
                 self.potential_vacancies[(run.spec, run.type)] = 0
             self.potential_vacancies[(run.spec, run.type)] += 1
 
-        sql = """
-select ro_run_no, ro_pet_no, ro_date, ro_bk_no, ro_type from vwrunoccupancy"""
-        cursor.execute(sql)
-
-        for row in cursor:
+    def load_occupancy_rows(self, rows):
+        # gather the days of each booking in each run, then add them to the
+        # run as whole stays in one go
+        days = {}
+        for row in rows:
             run = self.runs[row[0]]
-            pet = self.pets.get(row[1])
+            pet = self.pets.pets.get(row[1])
             ro_date = row[2].date()
-            booking = self.bookings.get(row[3])
-            ro_type = row[4]
-            run.add_occupancy(booking, pet, ro_date, ro_type)
+            booking = self.bookings.bookings.get(row[3])
+            if booking is None:
+                log.error(f'Missing booking #{row[3]} in run {run.code}')
+                continue
+            booking_days = days.setdefault(run, {}).setdefault(booking, {})
+            day = booking_days.get(ro_date.toordinal())
+            if day is None:
+                booking_days[ro_date.toordinal()] = ([pet], row[4])
+            elif pet not in day[0]:
+                day[0].append(pet)
             if ro_date < self.min_date:
                 self.min_date = ro_date
             if ro_date > self.max_date:
                 self.max_date = ro_date
 
-        ro_date = self.min_date
-        one_day = timedelta(days=1)
-        while ro_date <= self.max_date:
-            self.vacancies[ro_date] = {}
-            for spec in self.runs_by_type.keys():
-                for run_type in self.runs_by_type[spec].keys():
-                    self.vacancies[ro_date][(spec, run_type)] = \
-                        self.potential_vacancies[(spec, run_type)]
-                    for run in self.runs_by_type[spec][run_type]:
-                        if ro_date in run.occupancy:
-                            self.vacancies[ro_date][(spec, run_type)] -= 1
-            ro_date += one_day
+        for run, run_days in days.items():
+            run.add_stays(
+                stay for booking, booking_days in run_days.items()
+                for stay in _day_stays(booking, booking_days))
 
-        self.loaded = True
+    def reload_occupancy(self, bk_nos):
+        """Re-read the run occupancy of the given bookings"""
+        bk_nos = set(bk_nos)
+        for run in self.runs.values():
+            run.remove_bookings(bk_nos)
+
+        for keys in in_lists(bk_nos):
+            self.load_occupancy_rows(self.env.iter_query(
+                f"{SQL_RUNOCCUPANCY}\nwhere ro_bk_no in ({keys})"))
+
+        if self.calendar is None:
+            self.compute_vacancies()
+
+    def compute_vacancies(self):
+        """
+        Build the vacancy calendar from scratch. From then on each run keeps
+        it up to date as its occupancy changes.
+        """
+        self.calendar = VacancyCalendar.from_runs(
+            self.runs_by_type, self.min_date, self.max_date)
+        for run in self.runs.values():
+            run.calendar = self.calendar
+
+    def remove_booking(self, booking):
+        """Take a booking out of every run, e.g. on cancellation"""
+        for run in self.runs.values():
+            run.remove_bookings({booking.no})
+
+    def apply_booking_delta(self, booking, placements=()):
+        """
+        Replace a booking's occupancy: the booking is taken out of every run
+        and then placed as given, keeping the vacancy calendar current.
+        An empty placements cancels the booking's occupancy.
+        :param booking: the booking added, amended, moved or cancelled
+        :param placements: iterable of (run, pets) or
+            (run, pets, start_date, end_date); dates default to the booking's
+        """
+        self.remove_booking(booking)
+        for placement in placements:
+            run, pets = placement[0], placement[1]
+            if len(placement) > 2:
+                start_date, end_date = placement[2], placement[3]
+            else:
+                start_date, end_date = booking.start_date, booking.end_date
+            run.add_stay(booking, pets, start_date, end_date)
+
+    def vacancy(self, ro_date, spec, run_type):
+        """Number of vacant runs of a given type on a given day"""
+        return self.calendar.vacancy(ro_date, spec, run_type)
 
     def check_availability(self, from_date, to_date, spec, run_type, run_count=1):
         """
@@ -91,14 +348,55 @@ select ro_run_no, ro_pet_no, ro_date, ro_bk_no, ro_type from vwrunoccupancy"""
         :return:
         """
 
-        one_day = timedelta(days=1)
-        ro_date = from_date
-        while ro_date <= to_date:
-            if self.vacancies[ro_date][[spec, run_type]] < run_count:
-                return False
-            ro_date += one_day
+        return self.calendar.min_vacancy(
+            from_date, to_date, spec, run_type) >= run_count
+
+    def min_vacancy(self, from_date, to_date, spec, run_type):
+        return self.calendar.min_vacancy(from_date, to_date, spec, run_type)
+
+    def stays_in(self, run, first, last):
+        """(first, last, booking) of the stays in run between two ordinals"""
+        return [
+            (stay.first, stay.last, stay.booking)
+            for stay in run._overlapping(first, last)]
+
+    def scenario(self):
+        """
+        Start a what-if Scenario on top of the loaded occupancy. Nothing is
+        changed here unless the scenario is committed.
+        """
+        return Scenario(self)
+
+    def find_availability(self, spec, run_type, stay_length, run_count=1,
+                          from_date=None, horizon=365, near=None, limit=5):
+        """
+        Find the earliest stretches of stay_length days with run_count runs
+        of a type vacant throughout, or those closest to a preferred date.
+        :param spec:        species, 'Cat' or 'Dog'
+        :param run_type:    run type, e.g. 'Standard' or 'Double'
+        :param stay_length: number of days, first and last day included
+        :param run_count:   number of runs required (default to 1)
+        :param from_date:   earliest start date (default to today)
+        :param horizon:     number of days after from_date to search
+        :param near:        preferred start date; if given, the windows
+                            closest to it are returned instead of the earliest
+        :param limit:       maximum number of windows returned
+        :return: list of (start_date, end_date), in start date order
+        """
+        if from_date is None:
+            from_date = date.today()
+        first = _as_date(from_date).toordinal()
+        starts = self.calendar.feasible_starts(
+            spec, run_type, stay_length, run_count, first, first + horizon)
 
-        return True
+        if near is not None:
+            preferred = _as_date(near).toordinal()
+            starts = sorted(starts, key=lambda o: (abs(o - preferred), o))
+        starts = sorted(starts[:limit])
+
+        return [
+            (date.fromordinal(o), date.fromordinal(o + stay_length - 1))
+            for o in starts]
 
     def allocate_booking(self, booking, run_type=None, pets=None, start_date=None,
         stay_length=0):
@@ -112,14 +410,20 @@ select ro_run_no, ro_pet_no, ro_date, ro_bk_no, ro_type from vwrunoccupancy"""
             defaults to booking.start_date
         :param stay_length: number of days to be allocated.
             defaults to length of booking
-        :return: True for success, False for failure
+        Stays displaced by the booking are moved to another run of the same
+        type that is free for their whole remainder, without displacing
+        anyone in turn.
+        :return: list of displaced (booking, pets, start_date, stay_length)
+            that could not be moved, empty for success
         """
 
         if pets is None:
             pets = booking.pets
 
+        unplaced = []
+
         for spec in ['Cat', 'Dog']:
-            spec_pets = filter(lambda p: p.spec == spec, pets)
+            spec_pets = [p for p in pets if p.spec == spec]
             if spec_pets:
                 if spec == 'Cat' or run_type is None:
                     spec_run_type = 'Standard'
@@ -136,69 +440,588 @@ select ro_run_no, ro_pet_no, ro_date, ro_bk_no, ro_type from vwrunoccupancy"""
                           key=lambda r: r.free_length(start_date, stay_length))
 
                 move_list = []
-                run.add_occupancy_range(booking, spec_pets, booking.start_date,
+                run.add_occupancy_range(booking, spec_pets, start_date,
                     stay_length, move_list)
-                while move_list:
-                    to_move = move_list.pop(0)
-                    self.allocate_booking(to_move[0][0], run.run_type,
-                        to_move[0][1], to_move[1], to_move[2])
+                runs = self.runs_by_type[spec][run.type]
+                for (moved, moved_pets), moved_date, days in move_list:
+                    free = [r for r in runs
+                            if r.free_length(moved_date, days) >= days]
+                    if not free:
+                        log.warning(
+                            f'No free {spec} run for booking #{moved.no} '
+                            f'from {moved_date} for {days} days')
+                        unplaced.append((moved, moved_pets, moved_date, days))
+                        continue
+                    free[0].add_stay(
+                        moved, moved_pets, moved_date,
+                        date.fromordinal(moved_date.toordinal() + days - 1))
+
+        return unplaced
+
+    def allocate_bookings(self, bookings, run_types=None):
+        """
+        Allocate a batch of bookings into runs in a single pass.
+        Any existing allocation of these bookings is discarded; occupancy of
+        other bookings is left in place. Within each (spec, run type),
+        stays are taken in order of departure and each goes to the free run
+        that became vacant most recently before its arrival - the greedy
+        that places the largest number of stays on identical runs.
+        All pets of a spec in a booking share a run.
+        :param bookings: bookings to be allocated
+        :param run_types: optional dict of bk_no to the run type for its dogs.
+            Dogs otherwise, and all cats, use 'Standard' runs.
+        :return: (allocated, unplaced) - a dict of bk_no to the list of runs
+            assigned, and a list of (booking, spec) that could not be placed
+        """
+        if run_types is None:
+            run_types = {}
+
+        bookings = [b for b in bookings if b.start_date and b.end_date]
+        bk_nos = set(b.no for b in bookings)
+        stays = {}
+        for booking in bookings:
+            for spec in ('Cat', 'Dog'):
+                spec_pets = [p for p in booking.pets if p and p.spec == spec]
+                if not spec_pets:
+                    continue
+                if spec == 'Dog':
+                    spec_run_type = run_types.get(booking.no, 'Standard')
+                else:
+                    spec_run_type = 'Standard'
+                first = _as_date(booking.start_date).toordinal()
+                last = _as_date(booking.end_date).toordinal()
+                stays.setdefault((spec, spec_run_type), []).append(
+                    (last, first, booking.no, booking, spec_pets))
+
+        for run in self.runs.values():
+            run.remove_bookings(bk_nos)
+
+        allocated = {}
+        unplaced = []
+        for (spec, run_type), group in stays.items():
+            runs = self.runs_by_type.get(spec, {}).get(run_type, [])
+            busy = {}
+            last_end = {}
+            for run in runs:
+                busy[run.no] = list(run.occupied_ranges())
+                last_end[run.no] = None
+
+            for last, first, bk_no, booking, spec_pets in sorted(group):
+                best = None
+                best_fit = None
+                for run in runs:
+                    if last_end[run.no] is not None and \
+                            last_end[run.no] >= first:
+                        continue
+                    fit = _fixed_fit(busy[run.no], first, last)
+                    if fit is None:
+                        continue
+                    if last_end[run.no] is not None:
+                        fit = max(fit, last_end[run.no])
+                    if best is None or fit > best_fit:
+                        best, best_fit = run, fit
+
+                if best is None:
+                    unplaced.append((booking, spec))
+                    continue
+
+                last_end[best.no] = last
+                allocated.setdefault(bk_no, []).append(best)
+                first_date = date.fromordinal(first)
+                last_date = date.fromordinal(last)
+                best.add_stay(booking, spec_pets, first_date, last_date)
+                self.min_date = min(self.min_date, first_date)
+                self.max_date = max(self.max_date, last_date)
+
+        if self.calendar is None:
+            self.compute_vacancies()
+        log.debug(
+            f'Allocated {len(allocated)} bookings, '
+            f'{len(unplaced)} stays could not be placed')
+        return allocated, unplaced
+
+
+def _fixed_fit(ranges, first, last):
+    """
+    Check a run's sorted, disjoint occupied ranges against a stay.
+    :return: None if the stay clashes, otherwise the last occupied day
+        before the stay (or -1), used to prefer the snuggest run
+    """
+    i = bisect_right(ranges, (last, UNBOUNDED))
+    if i and ranges[i - 1][1] >= first:
+        return None
+    if i:
+        return ranges[i - 1][1]
+    return -1
+
+
+class Scenario:
+    """
+    A copy-on-write what-if layer over Runs, or over another Scenario.
+    Allocations and removals are recorded in the layer only; reads fall
+    through to the layer below for every run the layer has not touched.
+    A scenario is discarded simply by dropping it, or applied to the layer
+    below with commit().
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.runs = base.runs
+        self.runs_by_type = base.runs_by_type
+        # bookings taken out in this layer, by bk_no
+        self.removed = {}
+        # stays added in this layer: run_no -> [(first, last, booking, pets)]
+        self.added = {}
+        # runs changed by this layer: (spec, run type) -> set of run_no
+        self.touched = {}
+
+    def scenario(self):
+        """Start a nested scenario on top of this one"""
+        return Scenario(self)
+
+    def _touch(self, run):
+        self.touched.setdefault((run.spec, run.type), set()).add(run.no)
+
+    def stays_in(self, run, first, last):
+        """(first, last, booking) of the stays in run between two ordinals"""
+        stays = [
+            stay for stay in self.base.stays_in(run, first, last)
+            if stay[2].no not in self.removed]
+        stays += [
+            (stay[0], stay[1], stay[2]) for stay in self.added.get(run.no, [])
+            if stay[0] <= last and stay[1] >= first]
+        return stays
+
+    def is_free(self, run, first_date, last_date):
+        return not self.stays_in(
+            run, _as_date(first_date).toordinal(),
+            _as_date(last_date).toordinal())
+
+    def vacancy(self, ro_date, spec, run_type):
+        vacant = self.base.vacancy(ro_date, spec, run_type)
+        ordinal = _as_date(ro_date).toordinal()
+        for run_no in self.touched.get((spec, run_type), ()):
+            run = self.runs[run_no]
+            if self.base.stays_in(run, ordinal, ordinal):
+                vacant += 1
+            if self.stays_in(run, ordinal, ordinal):
+                vacant -= 1
+        return vacant
+
+    def min_vacancy(self, from_date, to_date, spec, run_type):
+        if (spec, run_type) not in self.touched:
+            return self.base.min_vacancy(from_date, to_date, spec, run_type)
+        first = _as_date(from_date).toordinal()
+        last = _as_date(to_date).toordinal()
+        return min(
+            (self.vacancy(date.fromordinal(o), spec, run_type)
+             for o in range(first, last + 1)), default=UNBOUNDED)
+
+    def check_availability(self, from_date, to_date, spec, run_type,
+                           run_count=1):
+        return self.min_vacancy(
+            from_date, to_date, spec, run_type) >= run_count
+
+    def remove_booking(self, booking):
+        """Take a booking out of every run in this scenario"""
+        self.removed[booking.no] = booking
+        for run_no, stays in self.added.items():
+            self.added[run_no] = [s for s in stays if s[2] is not booking]
+        first = _as_date(booking.start_date).toordinal()
+        last = _as_date(booking.end_date).toordinal()
+        for run in self.runs.values():
+            if any(stay[2] is booking
+                   for stay in self.base.stays_in(run, first, last)):
+                self._touch(run)
+
+    def place(self, booking, run, pets=None, start_date=None, end_date=None):
+        """Put a booking's pets in a run, defaulting to the booking's dates"""
+        if pets is None:
+            pets = booking.pets
+        first = _as_date(start_date or booking.start_date).toordinal()
+        last = _as_date(end_date or booking.end_date).toordinal()
+        self.added.setdefault(run.no, []).append(
+            (first, last, booking, list(pets)))
+        self._touch(run)
+
+    def allocate_booking(self, booking, run_type=None):
+        """
+        Place a booking in free runs of this scenario, co-habiting pets of
+        each spec, without displacing anyone. Any earlier placement of the
+        booking in the scenario is replaced.
+        :return: list of runs used, or None if some pets could not be placed
+            (in which case nothing is recorded)
+        """
+        first = _as_date(booking.start_date).toordinal()
+        last = _as_date(booking.end_date).toordinal()
+
+        def others(run, first, last):
+            # the booking's own placement is about to be replaced
+            return [
+                stay for stay in self.stays_in(run, first, last)
+                if stay[2] is not booking]
+
+        chosen = []
+        for spec in ('Cat', 'Dog'):
+            spec_pets = [p for p in booking.pets if p and p.spec == spec]
+            if not spec_pets:
+                continue
+            spec_run_type = run_type if spec == 'Dog' and run_type \
+                else 'Standard'
+            best = None
+            best_fit = None
+            for run in self.runs_by_type.get(spec, {}).get(spec_run_type, []):
+                if any(run is c[0] for c in chosen) or \
+                        others(run, first, last):
+                    continue
+                # prefer the run occupied most recently before arrival
+                before = [s[1] for s in others(run, first - 30, first)]
+                fit = max(before, default=-1)
+                if best is None or fit > best_fit:
+                    best, best_fit = run, fit
+            if best is None:
+                return None
+            chosen.append((best, spec_pets))
+
+        self.remove_booking(booking)
+        for run, spec_pets in chosen:
+            self.place(booking, run, spec_pets)
+        return [run for run, _ in chosen]
+
+    def allocate_bookings(self, bookings, run_type=None):
+        """
+        Allocate several bookings in this scenario, in arrival order.
+        :return: (allocated, unplaced) - dict of bk_no to runs used, and the
+            list of bookings that could not be placed
+        """
+        allocated = {}
+        unplaced = []
+        for booking in sorted(
+                bookings, key=lambda b: (_as_date(b.start_date), b.no)):
+            runs = self.allocate_booking(booking, run_type)
+            if runs is None:
+                unplaced.append(booking)
+            else:
+                allocated[booking.no] = runs
+        return allocated, unplaced
+
+    def commit(self):
+        """Apply this scenario to the layer below"""
+        for booking in self.removed.values():
+            self.base.remove_booking(booking)
+        for run_no, stays in self.added.items():
+            run = self.runs[run_no]
+            for first, last, booking, pets in stays:
+                if isinstance(self.base, Scenario):
+                    self.base.place(
+                        booking, run, pets, date.fromordinal(first),
+                        date.fromordinal(last))
+                else:
+                    run.add_stay(booking, pets, date.fromordinal(first),
+                                 date.fromordinal(last))
+        self.removed = {}
+        self.added = {}
+        self.touched = {}
+
+
+class Stay:
+    """
+    A booking's pets occupying a run from first to last, held as date
+    ordinals (inclusive)
+    """
+
+    __slots__ = ('first', 'last', 'booking', 'pets', 'ro_type')
+
+    def __init__(self, first, last, booking, pets, ro_type=None):
+        self.first = first
+        self.last = last
+        self.booking = booking
+        self.pets = pets
+        self.ro_type = ro_type
+
+
+def _same_pets(pets, other_pets):
+    return len(pets) == len(other_pets) and all(p in other_pets for p in pets)
+
+
+def _day_stays(booking, days):
+    """
+    Stays of a booking from {ordinal: (pets, ro_type)}, joining consecutive
+    days with the same pets
+    """
+    stays = []
+    for ordinal in sorted(days):
+        pets, ro_type = days[ordinal]
+        if stays and stays[-1].last == ordinal - 1 and \
+                stays[-1].ro_type == ro_type and \
+                _same_pets(stays[-1].pets, pets):
+            stays[-1].last = ordinal
+        else:
+            stays.append(Stay(ordinal, ordinal, booking, pets, ro_type))
+    return stays
 
 
 class Run:
     """
-    Representing a dog kennel or cat pen
+    Representing a dog kennel or cat pen.
+    Occupancy is kept as a list of stays sorted by first day, so lookups
+    bisect into it rather than probing day by day.
     """
 
+    __slots__ = (
+        'no', 'code', 'stays', 'starts', 'max_span', 'spec', 'type', 'calendar')
+
     def __init__(self):
         self.no = -1
         self.code = ''
-        self.occupancy = {}
+        self.stays = []
+        # first day of each stay, parallel to stays, for bisecting
+        self.starts = []
+        # longest stay seen, bounding how far back an overlap can start
+        self.max_span = 0
         self.spec = ''
         self.type = ''
+        # vacancy calendar kept current as occupancy changes, once built
+        self.calendar = None
 
-    def add_occupancy(self, booking, pet, ro_date, ro_type=None):
-        if ro_date not in self.occupancy:
-            self.occupancy[ro_date] = {}
+    @property
+    def occupancy(self):
+        """
+        Read-only day by day view of the stays:
+        {date: {bk_no: (booking, pets, ro_type)}}.
+        It is built afresh on each access, so change occupancy through
+        add_occupancy, add_stay, clear_run etc. rather than through the view.
+        """
+        occupancy = {}
+        for stay in self.stays:
+            entry = (stay.booking, tuple(stay.pets), stay.ro_type)
+            for ordinal in range(stay.first, stay.last + 1):
+                day = occupancy.setdefault(date.fromordinal(ordinal), {})
+                day[stay.booking.no] = entry
+        return MappingProxyType({
+            day: MappingProxyType(entries)
+            for day, entries in occupancy.items()})
 
-        if booking.no not in self.occupancy[ro_date]:
-            self.occupancy[ro_date][booking.no] = [booking, [pet], ro_type]
-        else:
-            self.occupancy[ro_date][booking.no][1].append(pet)
+    def _insert(self, stay):
+        i = bisect_right(self.starts, stay.first)
+        self.stays.insert(i, stay)
+        self.starts.insert(i, stay.first)
+        self.max_span = max(self.max_span, stay.last - stay.first)
 
-    def free_length(self, ro_date, ro_length):
-        if ro_date in self.occupancy:
-            return 0
+    def _remove(self, stay):
+        i = bisect_left(self.starts, stay.first)
+        while self.stays[i] is not stay:
+            i += 1
+        del self.stays[i]
+        del self.starts[i]
+
+    def _overlapping(self, first, last):
+        """Stays occupying any day from first to last"""
+        lo = bisect_left(self.starts, first - self.max_span)
+        hi = bisect_right(self.starts, last)
+        return [
+            stay for stay in self.stays[lo:hi] if stay.last >= first]
 
+    def _coverage(self, first, last):
+        """Occupied flag for each day from first to last, if tracked"""
+        if self.calendar is None:
+            return None
+        flags = [False] * (last - first + 1)
+        for stay in self._overlapping(first, last):
+            for ordinal in range(
+                    max(stay.first, first), min(stay.last, last) + 1):
+                flags[ordinal - first] = True
+        return flags
+
+    def _notify(self, first, before):
+        """
+        Pass changes in occupied days since before (from _coverage) on to
+        the vacancy calendar
+        """
+        if before is None:
+            return
+        after = self._coverage(first, first + len(before) - 1)
         i = 0
+        while i < len(after):
+            if before[i] == after[i]:
+                i += 1
+                continue
+            j = i
+            while j + 1 < len(after) and before[j + 1] != after[j + 1] and \
+                    after[j + 1] == after[i]:
+                j += 1
+            self.calendar.add(
+                self.spec, self.type, first + i, first + j,
+                -1 if after[i] else 1)
+            i = j + 1
+
+    def _merge(self, stay):
+        """Merge stay with adjacent stays of the same booking and pets"""
+        for other in self._overlapping(stay.first - 1, stay.last + 1):
+            if other is stay or other.booking is not stay.booking or \
+                    other.ro_type != stay.ro_type or \
+                    not _same_pets(other.pets, stay.pets):
+                continue
+            if other.last == stay.first - 1 or other.first == stay.last + 1:
+                self._remove(stay)
+                self._remove(other)
+                stay = Stay(
+                    min(stay.first, other.first), max(stay.last, other.last),
+                    stay.booking, stay.pets, stay.ro_type)
+                self._insert(stay)
+        return stay
 
-        for i in range(ro_length):
-            if ro_date + timedelta(days=i) in self.occupancy:
+    def _cut(self, stay, first, last):
+        """Remove days first..last from stay, keeping what is left over"""
+        self._remove(stay)
+        if stay.first < first:
+            self._insert(Stay(
+                stay.first, first - 1, stay.booking, stay.pets, stay.ro_type))
+        if stay.last > last:
+            self._insert(Stay(
+                last + 1, stay.last, stay.booking, stay.pets, stay.ro_type))
+
+    def add_occupancy(self, booking, pet, ro_date, ro_type=None):
+        ordinal = _as_date(ro_date).toordinal()
+        before = self._coverage(ordinal, ordinal)
+        for stay in self._overlapping(ordinal, ordinal):
+            if stay.booking is booking:
+                if pet in stay.pets:
+                    return
+                self._cut(stay, ordinal, ordinal)
+                day = Stay(ordinal, ordinal, booking, stay.pets + [pet],
+                           stay.ro_type)
                 break
+        else:
+            day = Stay(ordinal, ordinal, booking, [pet], ro_type)
 
-        return i
+        self._insert(day)
+        self._merge(day)
+        self._notify(ordinal, before)
 
-    def same_length(self, current_date, bk_no):
-        current_set = self.occupancy[current_date][bk_no]
-        i = 1
-        while bk_no in self.occupancy[current_date + timedelta(days=i)]\
-             and self.occupancy[current_date + timedelta(days=i)][1] ==\
-              current_set[1]:
-            i += 1
+    def _add(self, stay):
+        before = self._coverage(stay.first, stay.last)
+        self._insert(stay)
+        self._merge(stay)
+        self._notify(stay.first, before)
 
-        return i
+    def add_stay(self, booking, pets, first_date, last_date, ro_type=None):
+        """Occupy the run with pets from first_date to last_date inclusive"""
+        self._add(Stay(
+            _as_date(first_date).toordinal(), _as_date(last_date).toordinal(),
+            booking, list(pets), ro_type))
+
+    def add_stays(self, stays):
+        """
+        Occupy the run with several stays, sorting them in once rather than
+        inserting each in turn. Stays of bookings already in the run, or
+        added once the vacancy calendar is built, go in one at a time so
+        they are merged and counted.
+        """
+        stays = list(stays)
+        bookings = set(id(stay.booking) for stay in stays)
+        if self.calendar is not None or \
+                any(id(stay.booking) in bookings for stay in self.stays):
+            for stay in stays:
+                self._add(stay)
+            return
+
+        self.stays += stays
+        self.stays.sort(key=attrgetter('first'))
+        self.starts = [stay.first for stay in self.stays]
+        self.max_span = max(
+            [self.max_span] + [stay.last - stay.first for stay in stays])
+
+    def occupants(self, ro_date):
+        """{bk_no: [booking, pets, ro_type]} for bookings in the run on a day"""
+        ordinal = _as_date(ro_date).toordinal()
+        return {
+            stay.booking.no: [stay.booking, stay.pets, stay.ro_type]
+            for stay in self._overlapping(ordinal, ordinal)}
+
+    def is_free(self, first_date, last_date):
+        first = _as_date(first_date).toordinal()
+        last = _as_date(last_date).toordinal()
+        return not self._overlapping(first, last)
+
+    def occupied_ranges(self):
+        """Consecutive stretches of occupied days, as (first, last) ordinals"""
+        first = last = None
+        for stay in self.stays:
+            if last is not None and stay.first <= last + 1:
+                last = max(last, stay.last)
+                continue
+            if first is not None:
+                yield first, last
+            first, last = stay.first, stay.last
+        if first is not None:
+            yield first, last
+
+    def remove_bookings(self, bk_nos):
+        removed = [stay for stay in self.stays if stay.booking.no in bk_nos]
+        if not removed:
+            return
+        first = min(stay.first for stay in removed)
+        last = max(stay.last for stay in removed)
+        before = self._coverage(first, last)
+        self.stays = [
+            stay for stay in self.stays if stay.booking.no not in bk_nos]
+        self.starts = [stay.first for stay in self.stays]
+        self._notify(first, before)
+
+    def free_length(self, ro_date, ro_length):
+        """
+        Number of consecutive free days from ro_date, up to ro_length
+        """
+        first = _as_date(ro_date).toordinal()
+        stays = self._overlapping(first, first + ro_length - 1)
+        if not stays:
+            return ro_length
+        return min(max(stay.first, first) for stay in stays) - first
+
+    def same_length(self, current_date, bk_no):
+        """
+        Number of days from current_date the booking stays on in this run
+        with the same pets
+        """
+        ordinal = _as_date(current_date).toordinal()
+        for stay in self._overlapping(ordinal, ordinal):
+            if stay.booking.no == bk_no:
+                return stay.last - ordinal + 1
+        return 0
 
     def clear_run(self, start_date, bk_no, stay_length):
-        for i in range(stay_length):
-            del self.occupancy[start_date + timedelta(days=i)][bk_no]
+        first = _as_date(start_date).toordinal()
+        last = first + stay_length - 1
+        before = self._coverage(first, last)
+        for stay in self._overlapping(first, last):
+            if stay.booking.no == bk_no:
+                self._cut(stay, first, last)
+        self._notify(first, before)
 
     def add_occupancy_range(self, booking, pets, from_date, day_count, reject_list):
-        for i in range(day_count):
-            current_date = from_date + timedelta(days=i)
-            if current_date in self.occupancy:
-                for bk_no in self.occupancy[current_date]:
-                    stay_length = self.same_length(current_date, bk_no)
-                    reject_list.append((self.occupancy[current_date], \
-                    current_date, stay_length))
-                    self.clear_run(current_date, bk_no, stay_length)
-            for pet in pets:
-                self.add_occupancy(booking, pet, current_date)
+        """
+        Occupy the run for day_count days, displacing whoever is there.
+        Each displaced stay is appended to reject_list as
+        ((booking, pets), first displaced date, number of days displaced).
+        """
+        first = _as_date(from_date).toordinal()
+        last = first + day_count - 1
+        overlapping = self._overlapping(first, last)
+        window_last = max([last] + [stay.last for stay in overlapping])
+        before = self._coverage(first, window_last)
+        for stay in overlapping:
+            displaced_from = max(stay.first, first)
+            if stay.booking is booking:
+                # the booking's own days outside the range stay as they are
+                self._cut(stay, displaced_from, min(stay.last, last))
+                continue
+            reject_list.append((
+                (stay.booking, stay.pets), date.fromordinal(displaced_from),
+                stay.last - displaced_from + 1))
+            self._cut(stay, displaced_from, stay.last)
+
+        stay = Stay(first, last, booking, list(pets))
+        self._insert(stay)
+        self._merge(stay)
+        self._notify(first, before)
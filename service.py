@@ -1,4 +1,6 @@
-from .env import log
+from .env import log, intern_str
+
+SQL_SERVICE = 'Select srv_no, srv_desc, srv_code from vwservice'
 
 
 class Services:
@@ -19,21 +21,22 @@ class Services:
         if self.loaded and not force:
             return
 
-        sql = 'Select srv_no, srv_desc, srv_code from vwservice'
-        cursor = self.env.get_cursor()
-        cursor.execute(sql)
+        self.load_rows(self.env.iter_query(SQL_SERVICE))
+
+        self.loaded = True
 
-        for row in cursor:
+    def load_rows(self, rows):
+        for row in rows:
             srv_no = row[0]
-            service = Service(srv_no, row[1], row[2])
+            service = Service(srv_no, intern_str(row[1]), intern_str(row[2]))
             self.services[srv_no] = service
 
-        self.loaded = True
-
 
 class Service:
     """Representing a PetAdmin service"""
 
+    __slots__ = ('srv_no', 'code', 'desc')
+
     def __init__(self, srv_no, desc, code):
         self.srv_no = srv_no
         self.code = code